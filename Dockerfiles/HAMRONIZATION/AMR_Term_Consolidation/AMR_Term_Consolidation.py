@@ -4,6 +4,7 @@ import numpy as np
 
 # Utilities
 import sys
+import os
 
 # Modules
 from scripts import card_matching,load_data,metadata, clean, utilities, term_consolidation
@@ -14,14 +15,46 @@ import logging
 
 
 # Main Script
-def main(hamronize_output, ontology_file, assembly_file, db_paths):
+def main(hamronize_output, ontology_file, assembly_file, db_paths, cache_dir=None, chunksize=None, threads=None, aligner=None, cascade=None, locus_mode=None):
     """Main execution function to orchestrate the workflow."""
-    logger = logging.getLogger(__name__)
+    ontology = load_data.retreive_card_ontology(ontology_file, cache_dir)
+    return process_sample(hamronize_output, assembly_file, ontology, db_paths, chunksize, threads, cache_dir, aligner, cascade, locus_mode)
+
+def process_sample(hamronize_output, assembly_file, ontology, db_paths, chunksize=None, threads=None, cache_dir=None, aligner=None, cascade=None, locus_mode=None):
+    """
+    Run steps 1-6 for one hAMRonize output and its assembly.
+
+    The ontology (the tuple returned by load_data.retreive_card_ontology) and the
+    BLAST databases are loaded by the caller, so a batch run shares them across samples.
+    `threads` is the core budget of the BLAST searches, see card_matching.run_blast_tasks,
+    `cache_dir` holds the BLAST result cache, see blast_cache.BlastCache,
+    `aligner` is the search backend, see card_matching.ALIGNERS, `cascade`
+    runs the searches as a cascade, see card_matching.BlastCascade, and
+    `locus_mode` extracts one sequence per loci group, see utilities.locus_regions.
+    Intermediary files are written to the current working directory.
+    """
+    graph, id_to_name, name_to_id, synonym_to_id, term_index = ontology
+    hamr_output_df, assembly = load_sample(hamronize_output, assembly_file, chunksize)
+    # Step 5: Match AMR hits to CARD DB
+    hamr_output_df = card_matching.match_to_card(
+        hamr_output_df, 
+        term_index,
+        id_to_name, 
+        assembly,
+        db_paths,
+        threads,
+        cache_dir,
+        aligner,
+        cascade,
+        locus_mode
+        )
+    return consolidate_sample(hamr_output_df, graph)
 
+def load_sample(hamronize_output, assembly_file, chunksize=None):
+    """Steps 1-4: load, clean and group the hAMRonize output. Returns it with the indexed assembly."""
     # Step 1: Load data
-    hamr_output = load_data.load_data(hamronize_output)
+    hamr_output = load_data.load_data(hamronize_output, chunksize)
     assembly = load_data.load_assembly(assembly_file)
-    graph, id_to_name, name_to_id, synonym_to_id = load_data.retreive_card_ontology(ontology_file)
 
     # Step 2: Clean data
     # TODO Figure out what to do with read_resfinder_df
@@ -33,18 +66,11 @@ def main(hamronize_output, ontology_file, assembly_file, db_paths):
 
     # Step 4: Generate metadata on tools and databases
     metadata.generate_metadata(hamr_output_df)
-    print("#### db_paths", db_paths)
-    # Step 5: Match AMR hits to CARD DB
-    hamr_output_df = card_matching.match_to_card(
-        hamr_output_df, 
-        graph, 
-        name_to_id, 
-        synonym_to_id,
-        id_to_name, 
-        assembly,
-        db_paths
-        )
-    
+    return hamr_output_df, assembly
+
+def consolidate_sample(hamr_output_df, graph):
+    """Step 6: consolidate the CARD matched hits. Returns (matched_df, consolidated_terms_df), both None without hits."""
+    logger = logging.getLogger(__name__)
     matched_df = utilities.relevant_information(hamr_output_df)
     if matched_df is not None:
         consolidated_terms_df =  term_consolidation.term_consolidation(matched_df, graph)
@@ -63,6 +89,17 @@ def main(hamronize_output, ontology_file, assembly_file, db_paths):
     logger.info("> Matching completed.")
     return matched_df, consolidated_terms_df  #hamr_output_df
 
+def save_outputs(hamronized_terms_df, consolidated_terms_df, output_dir="."):
+    """Write HARMONIZED_TERMS.tsv and CONSOLIDATED_TERMS.tsv, as empty files when there were no hits."""
+    harmonized_path = os.path.join(output_dir, "HARMONIZED_TERMS.tsv")
+    consolidated_path = os.path.join(output_dir, "CONSOLIDATED_TERMS.tsv")
+    if hamronized_terms_df is not None:
+        hamronized_terms_df.to_csv(harmonized_path, sep="\t", index=False)
+        consolidated_terms_df.to_csv(consolidated_path, sep="\t", index=False)
+    else:
+        open(harmonized_path, 'a').close()
+        open(consolidated_path, 'a').close()
+
 if __name__ == "__main__":
 
     # LOGGING
@@ -91,6 +128,20 @@ if __name__ == "__main__":
     logger.info(f"  > Database nucleotide homolog file: {database_nucl_homolog_file}")
     database_nucl_variant_file = args.database_nucl_variant_file
     logger.info(f"  > Database nucleotide variant file: {database_nucl_variant_file}")
+    cache_dir = None if args.no_cache else args.cache_dir
+    logger.info(f"  > Cache directory: {cache_dir}")
+    threads = args.threads or utilities.available_cores()
+    logger.info(f"  > BLAST threads: {threads}")
+    logger.info(f"  > Aligner: {args.aligner}")
+    cascade = None
+    if args.cascade:
+        try:
+            cascade = card_matching.BlastCascade(args.cascade_order, args.cascade_identity, args.cascade_coverage)
+        except ValueError as e:
+            logger.error(f"    {e}")
+            sys.exit(1)
+        logger.info(f"  > BLAST cascade: {cascade.order}")
+    logger.info(f"  > Locus extraction: {args.locus_extraction}")
 
     db_paths = {
     "prot_homolog": database_prot_homolog_file,
@@ -109,8 +160,8 @@ if __name__ == "__main__":
     utilities.validate_file(args.assembly_file)
     # logger.info(f"> Input files validated: {args.hamronize_output_file}, {args.ontology_file}, {args.assembly_file}")
 
-    for db_name, db_path in db_paths.items():
-        utilities.validate_blast_db(db_path, db_name)
+    # BLAST databases are built once; match_to_card looks them up by name.
+    blast_dbs = {db_name: utilities.validate_blast_db(db_path, db_name, cache_dir) for db_name, db_path in db_paths.items()}
     ###########################################################################
 
     # RUN MAIN FUNCTION
@@ -120,19 +171,21 @@ if __name__ == "__main__":
             hamronize_file, 
             ontology_file, 
             assembly_file, 
-            db_paths
+            blast_dbs,
+            cache_dir,
+            args.chunksize,
+            threads,
+            card_matching.ALIGNERS[args.aligner](),
+            cascade,
+            args.locus_extraction
             )
         
         logger.info(f"PROCESSING COMPLETED SUCCESSFULLY ----------------------------------------------------------------------------------------------\n")
-        if harmaonized_terms is not None:
+        if hamronized_terms_df is not None:
             logger.info(hamronized_terms_df.shape)
             logger.info(consolidated_terms_df)
-            # Save the final dataframe as a TSV file
-            hamronized_terms_df.to_csv("HARMONIZED_TERMS.tsv", sep="\t", index=False)
-            consolidated_terms_df.to_csv("CONSOLIDATED_TERMS.tsv", sep="\t", index=False)
-        else:
-            open("HARMONIZED_TERMS.tsv", 'a').close()
-            open("CONSOLIDATED_TERMS.tsv", 'a').close()
+        # Save the final dataframes as TSV files
+        save_outputs(hamronized_terms_df, consolidated_terms_df)
         logger.info(f"Processed data saved.")
         
     except Exception as e:
@@ -0,0 +1,313 @@
+# Data handling and analysis
+import pandas as pd
+
+# Utilities
+import sys
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+# Modules
+from scripts import card_matching, load_data, utilities
+import AMR_Term_Consolidation
+import logger_config
+
+import logging
+
+logger = logging.getLogger("term_consolidation")
+
+# Reference data shared by every sample handled in a worker process, set by init_worker.
+_shared = {}
+
+
+def read_manifest(manifest_file) -> pd.DataFrame:
+    """
+    Read the batch manifest: a TSV with a header and the columns `hamronize_output`
+    and `assembly`, plus an optional `sample` column. Relative paths are resolved
+    against the manifest's directory. Samples default to the assembly file name.
+    """
+    manifest = pd.read_table(manifest_file, dtype=str)
+    missing = {"hamronize_output", "assembly"} - set(manifest.columns)
+    if missing:
+        logger.error(f"    Manifest {manifest_file} is missing columns: {sorted(missing)}")
+        sys.exit(1)
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    for column in ["hamronize_output", "assembly"]:
+        manifest[column] = [os.path.join(base_dir, path) for path in manifest[column]]
+    if "sample" not in manifest.columns:
+        manifest["sample"] = [os.path.basename(path).split(".")[0] for path in manifest["assembly"]]
+
+    duplicated = manifest["sample"][manifest["sample"].duplicated()].tolist()
+    if duplicated:
+        logger.error(f"    Duplicate sample names in manifest: {duplicated}")
+        sys.exit(1)
+    return manifest[["sample", "hamronize_output", "assembly"]]
+
+def init_worker(ontology, blast_dbs, chunksize, threads, cache_dir, aligner, cascade, locus_mode):
+    """Hand the reference data loaded by the parent to a worker process once."""
+    _shared["ontology"] = ontology
+    _shared["blast_dbs"] = blast_dbs
+    _shared["chunksize"] = chunksize
+    _shared["threads"] = threads
+    _shared["cache_dir"] = cache_dir
+    _shared["aligner"] = aligner
+    _shared["cascade"] = cascade
+    _shared["locus_mode"] = locus_mode
+
+@contextmanager
+def sample_directory(output_dir, sample):
+    """Work inside the sample's sub-directory of `output_dir`; match_to_card writes its intermediary files to the working directory."""
+    sample_dir = os.path.join(output_dir, sample)
+    os.makedirs(sample_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(sample_dir)
+    try:
+        yield sample_dir
+    finally:
+        os.chdir(cwd)
+
+def run_sample(sample, hamronize_output, assembly_file, output_dir, keep_tables):
+    """
+    Process one sample inside its own sub-directory of `output_dir`.
+
+    Returns (sample, succeeded, hamronized_terms_df, consolidated_terms_df); the
+    tables are only returned when `keep_tables` is set, for the combined output.
+    """
+    with sample_directory(output_dir, sample) as sample_dir:
+        try:
+            logger.info(f"  > [{sample}] Processing {hamronize_output}")
+            if os.path.getsize(hamronize_output) == 0:
+                hamronized_terms_df, consolidated_terms_df = None, None
+            else:
+                hamronized_terms_df, consolidated_terms_df = AMR_Term_Consolidation.process_sample(
+                    hamronize_output,
+                    assembly_file,
+                    _shared["ontology"],
+                    _shared["blast_dbs"],
+                    _shared["chunksize"],
+                    _shared["threads"],
+                    _shared["cache_dir"],
+                    _shared["aligner"],
+                    _shared["cascade"],
+                    _shared["locus_mode"]
+                    )
+            AMR_Term_Consolidation.save_outputs(hamronized_terms_df, consolidated_terms_df)
+            logger.info(f"  > [{sample}] Processed data saved in {sample_dir}")
+        except (Exception, SystemExit):
+            # load_data exits on unreadable input; keep the other samples going.
+            logger.exception(f"  > [{sample}] An error occurred during processing.")
+            return sample, False, None, None
+
+    if not keep_tables:
+        return sample, True, None, None
+    return sample, True, hamronized_terms_df, consolidated_terms_df
+
+def prepare_sample(sample, hamronize_output, assembly_file, output_dir):
+    """
+    Pooled mode, first pass: steps 1-5 of one sample up to the BLAST searches.
+
+    Returns (sample, succeeded, hamr_output_df, query_maps), see
+    card_matching.prepare_blast_queries; hamr_output_df is None for an empty
+    hAMRonize output and query_maps is None when there is nothing to search.
+    """
+    with sample_directory(output_dir, sample):
+        try:
+            logger.info(f"  > [{sample}] Preparing {hamronize_output}")
+            if os.path.getsize(hamronize_output) == 0:
+                return sample, True, None, None
+            _, id_to_name, _, _, term_index = _shared["ontology"]
+            hamr_output_df, assembly = AMR_Term_Consolidation.load_sample(hamronize_output, assembly_file, _shared["chunksize"])
+            hamr_output_df, query_maps = card_matching.prepare_blast_queries(
+                hamr_output_df, term_index, id_to_name, assembly, _shared["blast_dbs"], _shared["locus_mode"])
+        except (Exception, SystemExit):
+            logger.exception(f"  > [{sample}] An error occurred during processing.")
+            return sample, False, None, None
+    return sample, True, hamr_output_df, query_maps
+
+def finish_sample(sample, hamr_output_df, task_results, output_dir, keep_tables):
+    """
+    Pooled mode, last pass: merge the sample's share of the pooled BLAST results, then step 6.
+
+    `task_results` holds the (blast_results, error) of each card_matching.BLAST_TASKS
+    task, or is None when the sample had nothing to search. Returns the same as run_sample.
+    """
+    with sample_directory(output_dir, sample) as sample_dir:
+        try:
+            if hamr_output_df is None:
+                hamronized_terms_df, consolidated_terms_df = None, None
+            else:
+                if task_results is not None:
+                    hamr_output_df = card_matching.merge_blast_tasks(hamr_output_df, card_matching.BLAST_TASKS, task_results)
+                    card_matching.log_blast_matches(hamr_output_df)
+                hamronized_terms_df, consolidated_terms_df = AMR_Term_Consolidation.consolidate_sample(
+                    hamr_output_df, _shared["ontology"][0])
+            AMR_Term_Consolidation.save_outputs(hamronized_terms_df, consolidated_terms_df)
+            logger.info(f"  > [{sample}] Processed data saved in {sample_dir}")
+        except Exception:
+            logger.exception(f"  > [{sample}] An error occurred during processing.")
+            return sample, False, None, None
+
+    if not keep_tables:
+        return sample, True, None, None
+    return sample, True, hamronized_terms_df, consolidated_terms_df
+
+def run_pooled(executor, manifest, output_dir, keep_tables, blast_dbs, threads, cache_dir, aligner):
+    """
+    Process the samples with one pooled BLAST search per task (see card_matching.run_pooled_blast_tasks).
+
+    The samples are prepared in the `executor`, searched together in the
+    `pooled` sub-directory of `output_dir` on all `threads`, then finished in
+    the `executor`. Returns (results, failed) as the per-sample run does.
+    """
+    results = {}
+    failed = []
+    prepared = {}
+    futures = [
+        executor.submit(prepare_sample, row.sample, row.hamronize_output, row.assembly, output_dir)
+        for row in manifest.itertuples()
+    ]
+    for future in as_completed(futures):
+        sample, succeeded, hamr_output_df, query_maps = future.result()
+        if succeeded:
+            prepared[sample] = (hamr_output_df, query_maps)
+        else:
+            failed.append(sample)
+
+    sample_queries = {
+        sample: (os.path.join(output_dir, sample), query_maps)
+        for sample, (_, query_maps) in prepared.items() if query_maps is not None
+    }
+    task_results = {}
+    if sample_queries:
+        logger.info(f"BLASTING POOLED MISSING HITS OF {len(sample_queries)} SAMPLES ---------------------------------------------------------------------------\n")
+        with sample_directory(output_dir, "pooled"):
+            task_results = card_matching.run_pooled_blast_tasks(sample_queries, blast_dbs, threads, cache_dir, aligner)
+
+    futures = [
+        executor.submit(finish_sample, sample, hamr_output_df, task_results.get(sample), output_dir, keep_tables)
+        for sample, (hamr_output_df, _) in prepared.items()
+    ]
+    for future in as_completed(futures):
+        sample, succeeded, hamronized_terms_df, consolidated_terms_df = future.result()
+        if succeeded:
+            results[sample] = (hamronized_terms_df, consolidated_terms_df)
+        else:
+            failed.append(sample)
+    return results, failed
+
+def save_combined_outputs(results, output_dir):
+    """Concatenate per-sample tables, tagged with a leading `sample` column."""
+    for name, position in [("HARMONIZED_TERMS", 0), ("CONSOLIDATED_TERMS", 1)]:
+        tables = [tables[position].assign(sample=sample) for sample, tables in results.items() if tables[position] is not None]
+        path = os.path.join(output_dir, f"COMBINED_{name}.tsv")
+        if tables:
+            combined = pd.concat(tables, ignore_index=True)
+            combined = combined[["sample"] + [column for column in combined.columns if column != "sample"]]
+            combined.to_csv(path, sep="\t", index=False)
+        else:
+            open(path, 'a').close()
+        logger.info(f"  > Combined table saved at {path}")
+
+
+if __name__ == "__main__":
+
+    # LOGGING
+    logger = logger_config.setup_logger()
+    title = "AMR_Term_Consolidation batch started."
+    logger.info(f"\n{'*' * (len(title) + 8)}\n* {title} *\n{'*' * (len(title) + 8)}")
+    ###########################################################################
+
+    # PARSING ARGUMENTS
+    args = utilities.parse_batch_arguments()
+    output_dir = os.path.abspath(args.output_dir)
+    cache_dir = None if args.no_cache else args.cache_dir
+    logger.info(f"  > Manifest file: {args.manifest_file}")
+    logger.info(f"  > Ontology file: {args.ontology_file}")
+    logger.info(f"  > Output directory: {output_dir}")
+    logger.info(f"  > Workers: {args.workers}")
+    logger.info(f"  > Cache directory: {cache_dir}")
+    if args.pooled:
+        # One pooled search per task, run by the parent process on every core.
+        threads = args.threads or utilities.available_cores()
+        logger.info(f"  > Pooled BLAST threads: {threads}")
+    else:
+        # Samples run side by side, so each one gets its share of the cores for BLAST.
+        threads = args.threads or max(1, utilities.available_cores() // max(1, args.workers))
+        logger.info(f"  > BLAST threads per sample: {threads}")
+    logger.info(f"  > Aligner: {args.aligner}")
+    if args.pooled and args.cascade:
+        logger.error("    --cascade runs the searches of one sample at a time and cannot be combined with --pooled")
+        sys.exit(1)
+    cascade = None
+    if args.cascade:
+        try:
+            cascade = card_matching.BlastCascade(args.cascade_order, args.cascade_identity, args.cascade_coverage)
+        except ValueError as e:
+            logger.error(f"    {e}")
+            sys.exit(1)
+        logger.info(f"  > BLAST cascade: {cascade.order}")
+    logger.info(f"  > Locus extraction: {args.locus_extraction}")
+
+    db_paths = {
+    "prot_homolog": args.database_prot_homolog_file,
+    "prot_variant": args.database_prot_variant_file,
+    "nucl_homolog": args.database_nucl_homolog_file,
+    "nucl_variant": args.database_nucl_variant_file,
+    }
+    ###########################################################################
+
+    # VALIDATE INPUT FILES
+    logger.info(f"  > Validating input files...")
+    utilities.validate_file(args.manifest_file)
+    utilities.validate_file(args.ontology_file)
+    manifest = read_manifest(args.manifest_file)
+    for row in manifest.itertuples():
+        utilities.validate_file(row.hamronize_output)
+        utilities.validate_file(row.assembly)
+    if args.pooled:
+        # Pooled query ids are tagged with the sample name, and FASTA ids end at the first space.
+        spaced = [sample for sample in manifest["sample"] if len(sample.split()) != 1 or sample == "pooled"]
+        if spaced:
+            logger.error(f"    Sample names must not contain spaces or be 'pooled' with --pooled: {spaced}")
+            sys.exit(1)
+    logger.info(f"  > {len(manifest)} samples in manifest.")
+    ###########################################################################
+
+    # LOAD SHARED REFERENCE DATA ONCE
+    os.makedirs(output_dir, exist_ok=True)
+    blast_dbs = {db_name: utilities.validate_blast_db(db_path, db_name, cache_dir) for db_name, db_path in db_paths.items()}
+    ontology = load_data.retreive_card_ontology(args.ontology_file, cache_dir)
+    ###########################################################################
+
+    # RUN SAMPLES
+    aligner = card_matching.ALIGNERS[args.aligner]()
+    with ProcessPoolExecutor(
+            max_workers=max(1, args.workers),
+            initializer=init_worker,
+            initargs=(ontology, blast_dbs, args.chunksize, threads, cache_dir, aligner, cascade, args.locus_extraction)) as executor:
+        if args.pooled:
+            results, failed = run_pooled(executor, manifest, output_dir, args.combined, blast_dbs, threads, cache_dir, aligner)
+        else:
+            results = {}
+            failed = []
+            futures = [
+                executor.submit(run_sample, row.sample, row.hamronize_output, row.assembly, output_dir, args.combined)
+                for row in manifest.itertuples()
+            ]
+            for future in as_completed(futures):
+                sample, succeeded, hamronized_terms_df, consolidated_terms_df = future.result()
+                if succeeded:
+                    results[sample] = (hamronized_terms_df, consolidated_terms_df)
+                else:
+                    failed.append(sample)
+
+    if args.combined:
+        # Keep manifest order in the combined tables.
+        ordered = {sample: results[sample] for sample in manifest["sample"] if sample in results}
+        save_combined_outputs(ordered, output_dir)
+
+    logger.info(f"PROCESSING COMPLETED: {len(results)} samples succeeded, {len(failed)} failed {failed}\n")
+    logger.info("Script finished.")
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,75 @@
+"""
+Benchmark CARD term matching: the row-wise matching_to_card apply against the
+columnar resolve_card_terms engine, on synthetic hAMRonize tables.
+
+Usage (from the AMR_Term_Consolidation directory):
+    python benchmarks/benchmark_card_matching.py /path/to/aro.obo --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts import card_matching, load_data
+
+
+def synthetic_hits(term_index, id_to_name, size, seed=0) -> pd.DataFrame:
+    """Rows drawn from real CARD accessions, names and synonyms, with cased variants and misses mixed in."""
+    rng = np.random.default_rng(seed)
+    accessions = [node_id.split(":", 1)[1] for node_id in id_to_name][:2000]
+    terms = [key for key, (_, kind, _) in term_index.items() if kind != "accession"][:5000]
+    terms += [term.upper() for term in terms[:500]] + [f"unknown_gene_{i}" for i in range(500)]
+    misses = [f"WP_{i:09d}.1" for i in range(1000)]
+
+    accession_pool = np.array(accessions + misses, dtype=object)
+    term_pool = np.array(terms, dtype=object)
+    return pd.DataFrame({
+        "reference_accession": accession_pool[rng.integers(0, len(accession_pool), size)],
+        "gene_symbol": term_pool[rng.integers(0, len(term_pool), size)],
+        "gene_name": term_pool[rng.integers(0, len(term_pool), size)],
+    })
+
+def run_rowwise(df, term_index, id_to_name):
+    df = df.copy()
+    df[["card_match_type", "card_match_name", "card_match_id"]] = np.nan
+    return df.apply(card_matching.matching_to_card, args=(term_index, id_to_name), axis=1)
+
+def run_columnar(df, term_index, id_to_name):
+    return card_matching.resolve_card_terms(df.copy(), term_index, id_to_name)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark row-wise and columnar CARD term matching.")
+    parser.add_argument("ontology_file", help="Path to the CARD aro.obo file")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="Table sizes to time")
+    parser.add_argument("--no_rowwise", action="store_true", help="Only time the columnar engine")
+    args = parser.parse_args()
+
+    _, id_to_name, _, _, term_index = load_data.retreive_card_ontology(args.ontology_file)
+
+    print(f"{'rows':>10} {'row-wise (s)':>14} {'columnar (s)':>14} {'speed-up':>10}")
+    for size in args.sizes:
+        df = synthetic_hits(term_index, id_to_name, size)
+
+        start = time.perf_counter()
+        columnar = run_columnar(df, term_index, id_to_name)
+        columnar_time = time.perf_counter() - start
+
+        if args.no_rowwise:
+            print(f"{size:>10} {'-':>14} {columnar_time:>14.3f} {'-':>10}")
+            continue
+
+        start = time.perf_counter()
+        rowwise = run_rowwise(df, term_index, id_to_name)
+        rowwise_time = time.perf_counter() - start
+
+        columns = ["card_match_type", "card_match_name", "card_match_id"]
+        pd.testing.assert_frame_equal(columnar[columns].astype(object), rowwise[columns].astype(object))
+        print(f"{size:>10} {rowwise_time:>14.3f} {columnar_time:>14.3f} {rowwise_time / columnar_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark sequence extraction for the BLAST fallback: the Biopython path
+(utilities.extract_sequence, then SeqIO.write) against the bytes engine of
+sequence_extraction streaming to FASTA, on a synthetic assembly.
+
+Usage (from the AMR_Term_Consolidation directory):
+    python benchmarks/benchmark_extraction.py --hits 1000 10000 100000
+"""
+import argparse
+import filecmp
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Bio import SeqIO
+from scripts import utilities
+from scripts.fasta_index import IndexedFasta
+from scripts.sequence_extraction import FastaStream, extract_region
+
+
+def synthetic_assembly(path, contigs, contig_length, seed=0):
+    """Random contigs with 60-column lines, a few N runs and soft-masked stretches."""
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    with open(path, "wb") as f:
+        for i in range(contigs):
+            sequence = bases[rng.integers(0, 4, contig_length)].copy()
+            sequence[rng.integers(0, contig_length, contig_length // 1000)] = ord("N")
+            masked = rng.integers(0, contig_length - 100)
+            sequence[masked:masked + 100] |= 0x20
+            data = sequence.tobytes()
+            f.write(f">contig_{i + 1} len={contig_length}\n".encode())
+            f.writelines(data[j:j + 60] + b"\n" for j in range(0, len(data), 60))
+
+def synthetic_hits(contigs, contig_length, size, seed=0):
+    """(contig, start, end, gene name) of gene-sized hits, half of them on the reverse strand."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(300, 3000, size)
+    starts = rng.integers(1, contig_length - 3000, size)
+    reverse = rng.random(size) < 0.5
+    return [
+        (f"contig_{contig}", int(end if rev else start), int(start if rev else end), f"{i}_tool_db")
+        for i, (contig, start, end, rev) in enumerate(zip(rng.integers(1, contigs + 1, size), starts, starts + lengths, reverse))
+    ]
+
+def run_biopython(assembly, hits, output_dir):
+    nucleotide_records, protein_records = [], []
+    count = 1
+    for contig, start, end, gene_name in hits:
+        pro_record, nuc_record, count = utilities.extract_sequence(assembly, contig, contig, start, end, gene_name, count)
+        nucleotide_records.append(nuc_record)
+        protein_records.append(pro_record)
+    SeqIO.write(nucleotide_records, os.path.join(output_dir, "nucleotide.fasta"), "fasta")
+    SeqIO.write(protein_records, os.path.join(output_dir, "protein.fasta"), "fasta")
+
+def run_bytes(assembly, hits, output_dir):
+    with FastaStream(os.path.join(output_dir, "nucleotide.fasta")) as nucleotide_out, \
+            FastaStream(os.path.join(output_dir, "protein.fasta")) as protein_out:
+        for contig, start, end, gene_name in hits:
+            nucleotide, protein, location = extract_region(assembly, contig, start, end)
+            nucleotide_out.write(gene_name, f"{contig}:{location}", nucleotide)
+            protein_out.write(gene_name, f"{contig}:{location}", protein)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Biopython and bytes-level sequence extraction.")
+    parser.add_argument("--hits", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="Numbers of hits to extract")
+    parser.add_argument("--contigs", type=int, default=2000, help="Contigs in the synthetic assembly")
+    parser.add_argument("--contig_length", type=int, default=50_000, help="Length of each contig")
+    args = parser.parse_args()
+
+    # extract_sequence logs every hit; keep the timings about extraction.
+    logging.getLogger("term_consolidation").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        assembly_file = os.path.join(tmp, "assembly.fasta")
+        synthetic_assembly(assembly_file, args.contigs, args.contig_length)
+        assembly = IndexedFasta(assembly_file)
+
+        print(f"{'hits':>10} {'biopython (s)':>14} {'bytes (s)':>14} {'speed-up':>10}")
+        for size in args.hits:
+            hits = synthetic_hits(args.contigs, args.contig_length, size)
+            biopython_dir = tempfile.mkdtemp(dir=tmp)
+            bytes_dir = tempfile.mkdtemp(dir=tmp)
+
+            start = time.perf_counter()
+            run_biopython(assembly, hits, biopython_dir)
+            biopython_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            run_bytes(assembly, hits, bytes_dir)
+            bytes_time = time.perf_counter() - start
+
+            for name in ["nucleotide.fasta", "protein.fasta"]:
+                assert filecmp.cmp(os.path.join(biopython_dir, name), os.path.join(bytes_dir, name), shallow=False), name
+            print(f"{size:>10} {biopython_time:>14.3f} {bytes_time:>14.3f} {biopython_time / bytes_time:>9.1f}x")
+        assembly.close()
+
+
+if __name__ == "__main__":
+    main()
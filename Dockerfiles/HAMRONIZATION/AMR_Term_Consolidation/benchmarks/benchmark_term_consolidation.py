@@ -0,0 +1,80 @@
+"""
+Benchmark loci group consolidation: the row-wise term_consolidation_rowwise
+against the columnar term_consolidation, on synthetic harmonized tables.
+
+Usage (from the AMR_Term_Consolidation directory):
+    python benchmarks/benchmark_term_consolidation.py /path/to/aro.obo --sizes 10000 100000 1000000
+"""
+import argparse
+import contextlib
+import io
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts import load_data, term_consolidation
+
+
+def synthetic_harmonized_terms(graph, size, seed=0) -> pd.DataFrame:
+    """A HARMONIZED_TERMS-like table: loci groups of 1-6 hits with CARD and tool identities and accessions."""
+    rng = np.random.default_rng(seed)
+    accessions = np.array([node for node in graph.nodes if str(node).startswith("ARO:")][:500] + [np.nan, ""], dtype=object)
+    tools = [("abricate", "card"), ("amrfinderplus", "ncbi"), ("rgi", "card"), ("resfinder", "resfinder")]
+    group_sizes = rng.integers(1, 7, size)
+    groups = np.repeat(np.arange(size), group_sizes)[:size]
+    card_pident = rng.choice(np.array([np.nan, "", 100.0, 99.1, 97.4, 88.0], dtype=object), size)
+    return pd.DataFrame({
+        "loci_groups": groups,
+        "permutations": [tools[i] for i in rng.integers(0, len(tools), size)],
+        "gene_symbol": [f"gene_{i}" for i in rng.integers(0, 2000, size)],
+        "sequence_identity": rng.choice([100.0, 99.5, 98.2, 90.0, np.nan], size),
+        "reference_accession": [f"WP_{i:09d}.1" for i in rng.integers(0, 1000, size)],
+        "card_match_type": "reference_accession",
+        "card_match_name": [f"name_{i}" for i in rng.integers(0, 500, size)],
+        "card_match_id": accessions[rng.integers(0, len(accessions), size)],
+        "pident": card_pident,
+        "input_gene_start": rng.integers(1, 100_000, size),
+        "input_gene_stop": rng.integers(100_000, 200_000, size),
+        "input_sequence_id": [f"contig_{i}" for i in rng.integers(1, 200, size)],
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark row-wise and columnar term consolidation.")
+    parser.add_argument("ontology_file", help="Path to the CARD aro.obo file")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="Table sizes to time")
+    parser.add_argument("--no_rowwise", action="store_true", help="Only time the columnar engine")
+    args = parser.parse_args()
+
+    # term_consolidation logs the loci groups it drops; keep the timings about consolidation.
+    logging.getLogger("term_consolidation").setLevel(logging.ERROR)
+    graph = load_data.retreive_card_ontology(args.ontology_file)[0]
+
+    print(f"{'rows':>10} {'row-wise (s)':>14} {'columnar (s)':>14} {'speed-up':>10}")
+    for size in args.sizes:
+        df = synthetic_harmonized_terms(graph, size)
+
+        start = time.perf_counter()
+        columnar = term_consolidation.term_consolidation(df, graph)
+        columnar_time = time.perf_counter() - start
+
+        if args.no_rowwise:
+            print(f"{size:>10} {'-':>14} {columnar_time:>14.3f} {'-':>10}")
+            continue
+
+        # loci_group prints a warning for every group it cannot consolidate.
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            rowwise = term_consolidation.term_consolidation_rowwise(df, graph)
+        rowwise_time = time.perf_counter() - start
+
+        assert columnar.to_csv(sep="\t", index=False) == rowwise.to_csv(sep="\t", index=False)
+        print(f"{size:>10} {rowwise_time:>14.3f} {columnar_time:>14.3f} {rowwise_time / columnar_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import contextlib
+import logging
+import os
+import sqlite3
+from scripts import utilities
+
+logger = logging.getLogger("term_consolidation")
+
+# Bump whenever the meaning of a stored hit changes, e.g. new columns or a new filter in card_matching.
+BLAST_CACHE_VERSION = 2
+
+# Columns of a stored hit, in BLAST -outfmt 6 order after qseqid.
+HIT_COLUMNS = ["sseqid", "pident", "length", "evalue", "bitscore", "qcovs", "stitle"]
+HIT_COLUMN_TYPES = {"sseqid": "TEXT", "pident": "REAL", "evalue": "REAL", "bitscore": "REAL", "stitle": "TEXT"}
+
+# SQLite limits the number of bound parameters per statement.
+LOOKUP_BATCH = 500
+
+
+class BlastCache:
+    """
+    Best BLAST hit per query sequence, persisted in SQLite across runs and samples.
+
+    A hit is keyed by the SHA-256 of the query sequence, the BLAST program, the
+    database checksum (see utilities.read_db_info) and the identity and coverage filters. Queries
+    without a hit passing the filter are stored too, with a NULL sseqid, so they
+    are not searched again. Every lookup and store opens its own connection, so
+    the concurrent BLAST tasks and batch workers can share one cache file.
+
+    Example:
+        >>> cache = BlastCache("~/.cache/amr_term_consolidation/blast_results_v2.sqlite", "blastp", db_checksum, 75, 0)
+        >>> hits, misses = cache.lookup({"3_abricate_card": "MSIQHFRVALIPFFAAF..."})
+    """
+
+    def __init__(self, path, program, db_checksum, min_pident, min_qcovs):
+        self.path = path
+        self.key = (program, db_checksum, float(min_pident), float(min_qcovs))
+        with self._connect() as connection:
+            connection.execute(
+                f"""CREATE TABLE IF NOT EXISTS blast_hits (
+                    seq_hash TEXT NOT NULL,
+                    program TEXT NOT NULL,
+                    db_checksum TEXT NOT NULL,
+                    min_pident REAL NOT NULL,
+                    min_qcovs REAL NOT NULL,
+                    {", ".join(f"{column} {HIT_COLUMN_TYPES.get(column, 'INTEGER')}" for column in HIT_COLUMNS)},
+                    PRIMARY KEY (seq_hash, program, db_checksum, min_pident, min_qcovs)
+                )"""
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """A connection for one transaction, committed unless the block raises, then closed."""
+        connection = sqlite3.connect(self.path, timeout=300)
+        try:
+            try:
+                # Readers do not block the writer, which matters with parallel batch workers.
+                connection.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError:
+                pass
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def lookup(self, queries):
+        """
+        Split `queries` ({query id: sequence}) into cached results and misses.
+
+        Returns (hits, misses): hits maps query ids to a tuple of HIT_COLUMNS values,
+        or None when the sequence is known to have no hit; misses is the
+        {query id: sequence} dict of queries that still need a search.
+        """
+        hashes = {query_id: utilities.sequence_hash(sequence) for query_id, sequence in queries.items()}
+        unique_hashes = list(set(hashes.values()))
+        stored = {}
+        with self._connect() as connection:
+            for i in range(0, len(unique_hashes), LOOKUP_BATCH):
+                batch = unique_hashes[i:i + LOOKUP_BATCH]
+                rows = connection.execute(
+                    f"SELECT seq_hash, {', '.join(HIT_COLUMNS)} FROM blast_hits "
+                    f"WHERE program = ? AND db_checksum = ? AND min_pident = ? AND min_qcovs = ? "
+                    f"AND seq_hash IN ({', '.join('?' * len(batch))})",
+                    (*self.key, *batch),
+                )
+                for seq_hash, *hit in rows:
+                    stored[seq_hash] = None if hit[0] is None else tuple(hit)
+
+        hits = {query_id: stored[seq_hash] for query_id, seq_hash in hashes.items() if seq_hash in stored}
+        misses = {query_id: sequence for query_id, sequence in queries.items() if query_id not in hits}
+        return hits, misses
+
+    def store(self, queries, best_hits):
+        """
+        Save the search results of `queries` ({query id: sequence}).
+
+        `best_hits` maps query ids to a tuple of HIT_COLUMNS values; queries
+        missing from it are stored as having no hit.
+        """
+        rows = []
+        for query_id, sequence in queries.items():
+            hit = best_hits.get(query_id)
+            rows.append((utilities.sequence_hash(sequence), *self.key, *(hit if hit is not None else [None] * len(HIT_COLUMNS))))
+        with self._connect() as connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO blast_hits VALUES ({', '.join('?' * (5 + len(HIT_COLUMNS)))})",
+                rows,
+            )
+
+def open_blast_cache(cache_dir, database, program, min_pident, min_qcovs):
+    """
+    Return the BlastCache for a search of `database` with `program`, or None.
+
+    The cache is disabled when `cache_dir` is None or the database has no
+    dbinfo record to take its checksum from (see utilities.validate_blast_db).
+    """
+    if cache_dir is None:
+        return None
+    info = utilities.read_db_info(database)
+    if info is None:
+        logger.info(f"    No checksum recorded for BLAST database {database}; BLAST results are not cached.")
+        return None
+    db_checksum = f"{info['fasta_sha256']}:{info['db_type']}:{info['blast_version']}"
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"blast_results_v{BLAST_CACHE_VERSION}.sqlite")
+    return BlastCache(path, program, db_checksum, min_pident, min_qcovs)
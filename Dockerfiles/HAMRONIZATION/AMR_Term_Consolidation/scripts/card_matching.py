@@ -2,27 +2,83 @@ import logging
 import pandas as pd
 import numpy as np
 import subprocess
-from scripts import metadata, utilities
+from Bio import SeqIO
+from scripts import metadata, utilities, load_data, blast_cache
 import os
+import glob
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 
 logger = logging.getLogger("term_consolidation")
 
+# BLAST hits at or below this percent identity, or below this percent query coverage, are discarded.
+BLAST_MIN_PIDENT = 75
+BLAST_MIN_QCOVS = 0
 
-def match_to_card(hamr_output_df, graph, name_to_id, synonym_to_id, id_to_name, assembly, db_paths):
+# Tabular output columns requested from BLAST; stitle must stay last.
+BLAST_COLUMNS = ["qseqid"] + blast_cache.HIT_COLUMNS
+BLAST_COLUMN_TYPES = {"qseqid": str, "sseqid": str, "stitle": str, "pident": float, "evalue": float, "bitscore": float}
+
+# (query FASTA, program, database, match type) of each CARD fallback search.
+BLAST_TASKS = [
+    ("./intermediary/missing_matches_protein.fasta", "blastp", "prot_homolog", "card_blastp_homolog"),
+    ("./intermediary/missing_matches_protein.fasta", "blastp", "prot_variant", "card_blastp_variant"),
+    ("./intermediary/missing_matches_nucleotide.fasta", "blastx", "prot_homolog", "card_blastx_homolog"),
+    ("./intermediary/missing_matches_nucleotide.fasta", "blastx", "prot_variant", "card_blastx_variant"),
+    ("./intermediary/missing_matches_nucleotide.fasta", "blastn", "nucl_homolog", "card_blastn_homolog"),
+    ("./intermediary/missing_matches_nucleotide.fasta", "blastn", "nucl_variant", "card_blastn_variant"),
+]
+
+
+def match_to_card(hamr_output_df, term_index, id_to_name, assembly, db_paths, threads=None, cache_dir=None, aligner=None, cascade=None, locus_mode=None):
     """
     Matches AMR hits to CARD DB and attempts BLAST-based matching for unmatched hits.
     
     Parameters:
     - hamr_output_df (pd.DataFrame): DataFrame with AMR gene matches.
-    - graph, name_to_id, synonym_to_id, id_to_name: CARD ontology mapping.
-    - assembly (dict): Genome assembly sequences.
-    - db_paths (dict): Dictionary containing paths to BLAST databases.
+    - term_index, id_to_name: CARD ontology lookups, see load_data.build_term_index.
+    - assembly (IndexedFasta): Indexed genome assembly.
+    - db_paths (dict): BLAST database prefixes by name (prot_homolog, prot_variant, nucl_homolog, nucl_variant).
+    - threads (int): Cores shared by the BLAST searches, defaults to utilities.available_cores().
+    - cache_dir (str): Directory of the BLAST result cache, disabled if None.
+    - aligner: Backend running the searches (see ALIGNERS), BLAST if None.
+    - cascade (BlastCascade): Run the BLAST tasks one after another, dropping resolved queries. Concurrent if None.
+    - locus_mode (str): Extract one sequence per loci group ("union" or "consensus"), see utilities.locus_regions.
     
     Returns:
     - pd.DataFrame: Updated DataFrame with matched AMR genes.
     """
 
+    hamr_output_df, query_maps = prepare_blast_queries(hamr_output_df, term_index, id_to_name, assembly, db_paths, locus_mode)
+    if query_maps is not None:
+        # Define BLAST parameters
+        blast_tasks = BLAST_TASKS
+
+        logger.info(f"BLASTING MISSING HITS ----------------------------------------------------------------------------------------------------------\n")
+        if cascade is not None:
+            # One task at a time, each searching only the queries still unresolved
+            hamr_output_df, query_maps = run_blast_cascade(
+                hamr_output_df, blast_tasks, db_paths, query_maps, cascade, threads, cache_dir, aligner)
+        else:
+            # Run the BLAST tasks concurrently, then update the dataframe in task order
+            hamr_output_df = merge_blast_tasks(
+                hamr_output_df, blast_tasks, run_blast_tasks(blast_tasks, db_paths, threads, cache_dir, aligner, query_maps))
+        log_blast_matches(hamr_output_df)
+
+    return hamr_output_df
+
+def prepare_blast_queries(hamr_output_df, term_index, id_to_name, assembly, db_paths, locus_mode=None):
+    """
+    Everything match_to_card does before BLAST.
+
+    Matches the CARD terms, writes the sequences of the still unmatched hits to
+    the intermediary FASTA files and assigns those identical to a CARD reference.
+    Returns the updated dataframe and the query maps of the FASTA files (see
+    utilities.make_fasta_file), or None when every hit matched a term.
+    With a `locus_mode` one sequence is extracted per loci group.
+    """
     logger.info(
         f"MATCHING AMR HITS TO CARD DB----------------------------------------------------------------------------------------------------------\n")
 
@@ -30,15 +86,8 @@ def match_to_card(hamr_output_df, graph, name_to_id, synonym_to_id, id_to_name,
     # Ensure output directory exists
     os.makedirs(output, exist_ok=True)
 
-    # Initialize match columns
-    hamr_output_df[["card_match_type", "card_match_name", "card_match_id"]] = np.nan
-
-    # Apply CARD matching function
-    hamr_output_df = hamr_output_df.apply(
-        matching_to_card, 
-        args=(graph, name_to_id, synonym_to_id, id_to_name), 
-        axis=1
-    )
+    # Match accessions, gene symbols and gene names to CARD terms
+    hamr_output_df = resolve_card_terms(hamr_output_df, term_index, id_to_name)
 
     # Log match success
     logger.info(
@@ -48,45 +97,69 @@ def match_to_card(hamr_output_df, graph, name_to_id, synonym_to_id, id_to_name,
 
     # Collect and generate metadata for missing matches
     missing_matches_df = hamr_output_df[hamr_output_df['card_match_id'].isna()]
-    if not missing_matches_df.empty:
-        missing_matches_df.to_csv(f"{output}/missing_matches.tsv", sep="\t", index=True)
-        metadata.generate_metadata(missing_matches_df)
-        utilities.make_fasta_file(missing_matches_df, assembly, "intermediary","missing_matches")
-
-        # Define BLAST parameters
-        blast_tasks = [
-            ("./intermediary/missing_matches_protein.fasta", "blastp", "prot_homolog", "card_blastp_homolog"),
-            ("./intermediary/missing_matches_protein.fasta", "blastp", "prot_variant", "card_blastp_variant"),
-            ("./intermediary/missing_matches_nucleotide.fasta", "blastx", "prot_homolog", "card_blastx_homolog"),
-            ("./intermediary/missing_matches_nucleotide.fasta", "blastx", "prot_variant", "card_blastx_variant"),
-            ("./intermediary/missing_matches_nucleotide.fasta", "blastn", "nucl_homolog", "card_blastn_homolog"),
-            ("./intermediary/missing_matches_nucleotide.fasta", "blastn", "nucl_variant", "card_blastn_variant"),
-        ]
-
-        logger.info(f"BLASTING MISSING HITS ----------------------------------------------------------------------------------------------------------\n")
-        # Run BLAST for each task and update dataframe
-        for fasta_file, blast_type, db_path, match_type in blast_tasks:
-            print("####BLAST_TASKS", fasta_file, blast_type, db_path, match_type)
-            try:
-                blast_results = blast_missing_hits(fasta_file, db_path, match_type, blast_type)
-                hamr_output_df = utilities.update_df(hamr_output_df, blast_results, match_type)
-            except Exception as e:
-                logger.error(f"BLAST {blast_type} failed for {match_type}: {e}")
+    if missing_matches_df.empty:
+        return hamr_output_df, None
+    missing_matches_df.to_csv(f"{output}/missing_matches.tsv", sep="\t", index=True)
+    metadata.generate_metadata(missing_matches_df)
+    query_maps = utilities.make_fasta_file(missing_matches_df, assembly, "intermediary","missing_matches", locus_mode)
+    query_maps = {os.path.normpath(fasta_file): query_map for fasta_file, query_map in query_maps.items()}
+
+    # Sequences identical to a CARD reference sequence are assigned without BLAST
+    exact_tasks = [
+        ("./intermediary/missing_matches_protein.fasta", "prot_homolog", "card_exact_prot_homolog"),
+        ("./intermediary/missing_matches_protein.fasta", "prot_variant", "card_exact_prot_variant"),
+        ("./intermediary/missing_matches_nucleotide.fasta", "nucl_homolog", "card_exact_nucl_homolog"),
+        ("./intermediary/missing_matches_nucleotide.fasta", "nucl_variant", "card_exact_nucl_variant"),
+    ]
+    return match_exact_sequences(hamr_output_df, exact_tasks, query_maps, db_paths)
 
-        logger.info(
+def log_blast_matches(hamr_output_df):
+    """Log the match types once the BLAST results are merged."""
+    logger.info(
         f"... Success of np.nan Matches:\n {metadata.match_metadata(hamr_output_df,'card_match_type')}\n"
         f"   {hamr_output_df['card_match_type'].isna().sum()} np.nan AMR hits will be matched via BLASTp."
     )
 
+def resolve_card_terms(hamr_output_df, term_index, id_to_name) -> pd.DataFrame:
+    """
+    Matches every AMR hit to a CARD term with one vectorized lookup per column.
+
+    The order of precedence is the same as matching_to_card: reference_accession,
+    then gene_symbol, then gene_name. Within a column the term index already
+    prefers names over synonyms. Adds the card_match_type, card_match_name and
+    card_match_id columns.
+    """
+    for column in ["card_match_type", "card_match_name", "card_match_id"]:
+        hamr_output_df[column] = pd.Series(np.nan, index=hamr_output_df.index, dtype=object)
+
+    lookups = [
+        ("reference_accession", load_data.lookup_terms(hamr_output_df["reference_accession"], term_index, kinds=("accession",), accession=True)),
+        ("gene_symbol", load_data.lookup_terms(hamr_output_df["gene_symbol"], term_index)),
+        ("gene_name", load_data.lookup_terms(hamr_output_df["gene_name"], term_index)),
+    ]
+    unmatched = pd.Series(True, index=hamr_output_df.index)
+    for column, hits in lookups:
+        found = unmatched & hits["card_id"].notna()
+        card_ids = hits.loc[found, "card_id"]
+        hamr_output_df.loc[found, "card_match_id"] = card_ids
+        if column == "reference_accession":
+            hamr_output_df.loc[found, "card_match_name"] = card_ids.map(id_to_name)
+            hamr_output_df.loc[found, "card_match_type"] = column
+        else:
+            hamr_output_df.loc[found, "card_match_name"] = hamr_output_df.loc[found, column].astype(object)
+            hamr_output_df.loc[found, "card_match_type"] = np.where(
+                hits.loc[found, "match_kind"] == "synonym", f"{column}(SYNONYM)", column)
+        unmatched &= ~found
     return hamr_output_df
 
-def matching_to_card(row, graph, name_to_id, synonym_to_id, id_to_name):
+def matching_to_card(row, term_index, id_to_name):
     """
     Matches a gene symbol to its corresponding CARD identifier using multiple matching strategies.
 
     This function checks for exact matches and matches based on gene symbols, gene_name, synonyms, 
     and reference accessions. The function also ensures that matches are 
-    added to the `row` with relevant match details.
+    added to the `row` with relevant match details. It is the row-by-row
+    counterpart of resolve_card_terms.
 
     Parameters:
     ----------
@@ -95,12 +168,8 @@ def matching_to_card(row, graph, name_to_id, synonym_to_id, id_to_name):
         - `reference_accession`: The reference accession for the gene.
         - `gene_symbol`: The gene symbol to be matched.
         - `gene_name`: The gene name to be matched.
-    graph : dict
-        A dictionary containing reference accessions as keys and their corresponding CARD identifiers as values.
-    name_to_id : dict
-        A dictionary mapping gene names to their corresponding CARD identifiers.
-    synonym_to_id : dict
-        A dictionary mapping gene synonyms to their corresponding CARD identifiers.
+    term_index : dict
+        Normalized CARD accessions, names and synonyms mapped to (CARD identifier, term kind, priority).
     id_to_name : dict
         A dictionary mapping CARD identifiers to their corresponding gene_names.
 
@@ -110,94 +179,524 @@ def matching_to_card(row, graph, name_to_id, synonym_to_id, id_to_name):
         The updated `row` with the following additional columns:
         - `card_match_name`: The matched gene symbol or accession name.
         - `card_match_id`: The CARD identifier corresponding to the match.
-        - `card_match_type`: The type of match ('reference_accession', 'gene_symbol', 'gene_symbol(SYNONYM)', or 'requires_blast').
+        - `card_match_type`: The type of match ('reference_accession', 'gene_symbol', 'gene_symbol(SYNONYM)', 'gene_name' or 'gene_name(SYNONYM)').
 
     Notes:
     -----
     - Exact matches are prioritized.
 
     """
-    match_found = False # Flag to track if a match has been found
-
-    # 1. Check for exact match to reference_accessionn
-    if "ARO:" + row['reference_accession'] in graph and not match_found:
-        row["card_match_name"] = id_to_name["ARO:" + row['reference_accession']]
-        row["card_match_id"] = "ARO:" + row['reference_accession']
-        row["card_match_type"]  = 'reference_accession'
-        match_found = True
-
-    # 2. Match gene_symbol to name
-    if row['gene_symbol'].lower() in name_to_id and not match_found:
-        row["card_match_name"] = row['gene_symbol']
-        row["card_match_id"] = name_to_id[row['gene_symbol'].lower()]
-        row["card_match_type"] = 'gene_symbol'
-        match_found = True
-        
-    # 3. Match gene_symbol to synonym
-    if row['gene_symbol'].lower() in synonym_to_id and not match_found:
-        row["card_match_name"] = row['gene_symbol']
-        row["card_match_id"] = synonym_to_id[row['gene_symbol'].lower()]
-        row["card_match_type"] = 'gene_symbol(SYNONYM)'
-        match_found = True
-    
-    # 4. Match gene_symbol to name
-    if row['gene_name'].lower() in name_to_id and not match_found:
-        row["card_match_name"] = row['gene_name']
-        row["card_match_id"] = name_to_id[row['gene_name'].lower()]
-        row["card_match_type"] = 'gene_name'
-        match_found = True
-
-    # 5. Match gene_symbol to synonym
-    if row['gene_name'].lower() in synonym_to_id and not match_found:
-        row["card_match_name"] = row['gene_name']
-        row["card_match_id"] = synonym_to_id[row['gene_name'].lower()]
-        row["card_match_type"] = 'gene_name(SYNONYM)'
-        match_found = True   
-        
-    return row     
-
-def blast_missing_hits(fasta_file:str, database: str, output_file : str, blast_type:str) -> pd.DataFrame:
-    num_reads = sum(1 for line in open(fasta_file) if line.startswith(">"))
-    logger.info(
-        f"> {blast_type.upper()} {num_reads} AMR hits against {output_file} DB")
-
-    # Run BLAST with additional filtering options
-    blast_command = [
-        blast_type,  # Change to "blastp" for protein sequences
-        "-query", fasta_file,
-        "-db", database,
-        "-out", f"intermediary/{output_file}_results.txt",
-        "-outfmt", "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore",
-        "-num_threads", "8",
-        "-max_hsps", "1",  # Ensure only one high-scoring segment per subject
+    # 1. Check for exact match to reference_accession
+    entry = term_index.get(load_data.normalize_accession(row['reference_accession']))
+    if entry is not None and entry[1] == "accession":
+        row["card_match_name"] = id_to_name[entry[0]]
+        row["card_match_id"] = entry[0]
+        row["card_match_type"] = 'reference_accession'
+        return row
+
+    # 2-5. Match gene_symbol, then gene_name, to a name or else a synonym
+    for column in ['gene_symbol', 'gene_name']:
+        entry = term_index.get(load_data.normalize_term(row[column]))
+        if entry is not None and entry[1] != "accession":
+            row["card_match_name"] = row[column]
+            row["card_match_id"] = entry[0]
+            row["card_match_type"] = column if entry[1] == "name" else f"{column}(SYNONYM)"
+            return row
+
+    return row
+
+def merge_blast_tasks(hamr_output_df, blast_tasks, task_results) -> pd.DataFrame:
+    """Update the dataframe with the (blast_results, error) of each task from run_blast_tasks, in task order."""
+    for (fasta_file, blast_type, db_name, match_type), (blast_results, error) in zip(blast_tasks, task_results):
+        if error is not None:
+            logger.error(f"BLAST {blast_type} failed for {match_type}: {error}")
+            continue
+        if blast_results.empty:
+            logger.info(f"    No {match_type} hits above {BLAST_MIN_PIDENT}% identity.")
+            continue
+        try:
+            hamr_output_df = utilities.update_df(hamr_output_df, blast_results, match_type)
+        except Exception as e:
+            logger.error(f"BLAST {blast_type} failed for {match_type}: {e}")
+    return hamr_output_df
+
+def match_exact_sequences(hamr_output_df, exact_tasks, query_maps, db_paths):
+    """
+    Assigns CARD references to extracted sequences identical to one, before BLAST.
+
+    For each (fasta_file, db_name, match_type) of `exact_tasks`, in order, the
+    queries of the FASTA file are looked up in the sequence index built with the
+    database (see utilities.write_sequence_index). Matched rows get the reference's
+    ARO accession and name, pident 100 and card_match_type `match_type` through
+    utilities.update_df. They are then removed from the query maps and the FASTA
+    files, so no BLAST task searches them again.
+
+    Returns the updated dataframe and query maps.
+    """
+    resolved = set()
+    queries = {}
+    for fasta_file, db_name, match_type in exact_tasks:
+        fasta_file = os.path.normpath(fasta_file)
+        query_map = query_maps.get(fasta_file)
+        index = utilities.read_sequence_index(db_paths.get(db_name, db_name))
+        if query_map is None or index is None:
+            continue
+        if fasta_file not in queries:
+            queries[fasta_file] = read_queries(fasta_file)
+
+        hits = []
+        for query_id, sequence in queries[fasta_file].items():
+            header = index.get(utilities.sequence_hash(sequence))
+            if header is None:
+                continue
+            reference_number, reference_name = parse_card_subject(header.split(" ", 1)[0], header)
+            hits.extend((row, reference_number, reference_name) for row in query_map[query_id] if row not in resolved)
+        if hits:
+            exact_df = pd.DataFrame(hits, columns=["row", "reference_number", "reference_name"]).set_index("row")
+            exact_df["pident"] = 100.0
+            hamr_output_df = utilities.update_df(hamr_output_df, exact_df, match_type)
+            resolved.update(exact_df.index)
+            logger.info(f"    {len(exact_df)} AMR hits identical to a {db_name} reference sequence.")
+
+    if resolved:
+        query_maps = drop_resolved_queries(query_maps, resolved)
+    return hamr_output_df, query_maps
+
+def drop_resolved_queries(query_maps, resolved) -> dict:
+    """Remove the `resolved` rows from the query maps, and queries left without rows from their FASTA files."""
+    updated = {}
+    for fasta_file, query_map in query_maps.items():
+        remaining = {query_id: [row for row in rows if row not in resolved] for query_id, rows in query_map.items()}
+        remaining = {query_id: rows for query_id, rows in remaining.items() if rows}
+        if len(remaining) < len(query_map):
+            records = [record for record in SeqIO.parse(fasta_file, "fasta") if record.id in remaining]
+            SeqIO.write(records, fasta_file, "fasta")
+        updated[fasta_file] = remaining
+    return updated
+
+class BlastCascade:
+    """
+    Settings of a cascading BLAST search (see run_blast_cascade).
+
+    `order` lists the match types of BLAST_TASKS in the order they run, all of
+    them in BLAST_TASKS order by default. A row counts as resolved once a hit
+    reaches `min_pident` identity and `min_qcovs` query coverage.
+    """
+
+    def __init__(self, order=None, min_pident=98.0, min_qcovs=90.0):
+        known = [task[3] for task in BLAST_TASKS]
+        unknown = [match_type for match_type in order or [] if match_type not in known]
+        if unknown:
+            raise ValueError(f"Unknown BLAST tasks in cascade order: {unknown}; choose from {known}")
+        self.order = list(order) if order else known
+        self.min_pident = min_pident
+        self.min_qcovs = min_qcovs
+
+    def resolved(self, blast_results) -> set:
+        """Rows whose hit passes the cascade thresholds."""
+        passed = (blast_results["pident"] >= self.min_pident) & (blast_results["qcovs"] >= self.min_qcovs)
+        return set(blast_results.index[passed])
+
+def run_blast_cascade(hamr_output_df, blast_tasks, db_paths, query_maps, cascade, threads=None, cache_dir=None, aligner=None):
+    """
+    Run the BLAST tasks one at a time in `cascade.order`, each on all `threads` cores.
+
+    After each task the results are merged with utilities.update_df, and rows
+    resolved at the cascade's identity and coverage are removed from the query
+    maps and FASTA files, so later tasks, e.g. blastx and blastn after a
+    near-exact blastp homolog hit, do not search them again.
+
+    Returns the updated dataframe and query maps.
+    """
+    tasks = {task[3]: task for task in blast_tasks}
+    threads = max(1, threads or utilities.available_cores())
+    logger.info(f"    Cascading BLAST tasks, resolving at {cascade.min_pident}% identity and {cascade.min_qcovs}% coverage: {cascade.order}")
+
+    for match_type in cascade.order:
+        fasta_file, blast_type, db_name, _ = tasks[match_type]
+        query_map = query_maps.get(os.path.normpath(fasta_file))
+        if not query_map:
+            logger.info(f"    ... {match_type}: no queries left to search")
+            continue
+
+        start = time.perf_counter()
+        try:
+            blast_results = blast_missing_hits(fasta_file, db_paths.get(db_name, db_name), match_type, blast_type, threads, cache_dir, aligner, query_map)
+        except Exception as e:
+            logger.error(f"BLAST {blast_type} failed for {match_type}: {e}")
+            continue
+        logger.info(f"    ... {match_type}: {time.perf_counter() - start:.2f}s wall time on {threads} threads")
+        if blast_results.empty:
+            logger.info(f"    No {match_type} hits above {BLAST_MIN_PIDENT}% identity.")
+            continue
+
+        hamr_output_df = utilities.update_df(hamr_output_df, blast_results, match_type)
+        resolved = cascade.resolved(blast_results)
+        if resolved:
+            query_maps = drop_resolved_queries(query_maps, resolved)
+            logger.info(f"    {len(resolved)} AMR hits resolved by {match_type}, skipped by the next searches.")
+    return hamr_output_df, query_maps
+
+def run_blast_tasks(blast_tasks, db_paths, threads=None, cache_dir=None, aligner=None, query_maps=None) -> list:
+    """
+    Run BLAST tasks concurrently within a budget of `threads` cores.
+
+    Each task gets a share of the cores proportional to its expected work, the
+    number of query sequences times the size of its database, and at least one
+    core. When there are more tasks than cores, tasks run one core each,
+    largest first, as cores free up. Returns (blast_results, error) per task,
+    in the order of `blast_tasks`. `query_maps` holds the query map of each
+    FASTA file, see utilities.make_fasta_file.
+    """
+    budget = max(1, threads or utilities.available_cores())
+    query_counts = {fasta_file: count_queries(fasta_file) for fasta_file, _, _, _ in blast_tasks}
+    weights = [
+        query_counts[fasta_file] * blast_db_size(db_paths.get(db_name, db_name))
+        for fasta_file, _, db_name, _ in blast_tasks
     ]
-    
-    subprocess.run(blast_command, check=True)
-
-    # Read BLAST output
-    blast_df = pd.read_csv(f"intermediary/{output_file}_results.txt", sep="\t", header=None, names=[
-        "qseqid", "sseqid", "pident", "length", "mismatch", "gapopen", 
-        "qstart", "qend", "sstart", "send", "evalue", "bitscore"
-    ])
-    # Extract the number before the first "_" and set it as the index
-    blast_df.index = blast_df["qseqid"].str.extract(r"^(\d+)")[0].astype(int)
-    # Filter for hits with pident > 75
-    blast_df = blast_df[blast_df["pident"] > 75]
-    blast_df = blast_df.sort_values(by=['qseqid'],ascending=False)
-
-    # Ensure only one hit per query sequence (qseqid)
-    blast_df = blast_df.drop_duplicates(subset="qseqid", keep="first")
-
-    # Extract the reference number (digits after 'ARO:')
-    # blast_df['reference_number'] = blast_df['sseqid'].str.extract(r'ARO:(\d+)')
-    # blast_df['reference_number'] = blast_df['sseqid'].str.split("|")[4]
-    blast_df['reference_number'] = blast_df['sseqid'].str.extract(r'(ARO:\d+)')
-
-
-    # Extract the reference name (text after last '|')
-    blast_df['reference_name'] = blast_df['sseqid'].str.extract(r'\|([^|]+)$')
+    task_threads = allocate_threads(weights, budget)
+    logger.info(f"    Running {len(blast_tasks)} BLAST tasks on {budget} cores: {dict(zip([task[3] for task in blast_tasks], task_threads))}")
+
+    def run(task, num_threads):
+        fasta_file, blast_type, db_name, match_type = task
+        start = time.perf_counter()
+        try:
+            result = blast_missing_hits(fasta_file, db_paths.get(db_name, db_name), match_type, blast_type, num_threads, cache_dir, aligner,
+                                        (query_maps or {}).get(os.path.normpath(fasta_file)))
+            error = None
+        except Exception as e:
+            result, error = None, e
+        logger.info(f"    ... {match_type}: {time.perf_counter() - start:.2f}s wall time on {num_threads} threads")
+        return result, error
+
+    # Largest tasks first, so a long search does not start last when cores are short.
+    order = sorted(range(len(blast_tasks)), key=lambda i: weights[i], reverse=True)
+    with ThreadPoolExecutor(max_workers=min(len(blast_tasks), budget) or 1) as executor:
+        futures = {i: executor.submit(run, blast_tasks[i], task_threads[i]) for i in order}
+    return [futures[i].result() for i in range(len(blast_tasks))]
+
+def run_pooled_blast_tasks(sample_queries, db_paths, threads=None, cache_dir=None, aligner=None) -> dict:
+    """
+    Run the BLAST_TASKS once for the missing matches of many samples.
+
+    `sample_queries` maps each sample to (sample directory, query maps), the
+    query maps as returned by prepare_blast_queries in that directory. The
+    queries of every sample are pooled into one FASTA file per query type in
+    ./intermediary, with ids tagged `<sample>|<query id>`; a sequence found in
+    several samples is searched once. Each BLAST task then runs a single time
+    through run_blast_tasks, so every database is loaded once per batch
+    instead of once per sample.
+
+    Returns {sample: [(blast_results, error) per BLAST_TASKS task]}, each
+    sample's results indexed by its own hAMRonize rows, ready for merge_blast_tasks.
+    """
+    os.makedirs("intermediary", exist_ok=True)
+    # Position i of the pooled query maps stands for the hAMRonize row pooled_rows[i] of a sample
+    pooled_rows = []
+    pooled_maps = {}
+    for fasta_file in dict.fromkeys(os.path.normpath(task[0]) for task in BLAST_TASKS):
+        records = {}
+        pooled_map = {}
+        by_sequence = {}
+        for sample, (sample_dir, query_maps) in sample_queries.items():
+            query_map = (query_maps or {}).get(fasta_file)
+            if not query_map:
+                continue
+            for query_id, sequence in read_queries(os.path.join(sample_dir, fasta_file)).items():
+                rows = query_map.get(query_id)
+                if not rows:
+                    continue
+                pooled_id = by_sequence.setdefault(sequence.upper(), f"{sample}|{query_id}")
+                if pooled_id not in records:
+                    records[pooled_id] = sequence
+                    pooled_map[pooled_id] = []
+                pooled_map[pooled_id].extend(range(len(pooled_rows), len(pooled_rows) + len(rows)))
+                pooled_rows.extend((sample, row) for row in rows)
+        with open(fasta_file, "w") as f:
+            f.writelines(f">{query_id}\n{sequence}\n" for query_id, sequence in records.items())
+        pooled_maps[fasta_file] = pooled_map
+        logger.info(f"    Pooled {len(records)} queries of {len(sample_queries)} samples into {fasta_file}")
+
+    task_results = run_blast_tasks(BLAST_TASKS, db_paths, threads, cache_dir, aligner, pooled_maps)
+
+    # Split every task's results back per sample, indexed by the sample's rows
+    samples = np.array([sample for sample, _ in pooled_rows], dtype=object)
+    rows = np.array([row for _, row in pooled_rows], dtype=int)
+    split = {sample: [] for sample in sample_queries}
+    for blast_results, error in task_results:
+        for sample in split:
+            if error is not None:
+                split[sample].append((None, error))
+                continue
+            positions = blast_results.index.to_numpy(dtype=int)
+            mine = samples[positions] == sample
+            sample_results = blast_results[mine].copy()
+            sample_results.index = pd.Index(rows[positions[mine]], dtype=int)
+            split[sample].append((sample_results, None))
+    return split
+
+def allocate_threads(weights, budget) -> list:
+    """Split `budget` cores across tasks in proportion to `weights`, at least one each (largest remainder)."""
+    if len(weights) >= budget:
+        return [1] * len(weights)
+    spare = budget - len(weights)
+    total = sum(weights)
+    if total == 0:
+        shares = [spare / len(weights)] * len(weights)
+    else:
+        shares = [spare * weight / total for weight in weights]
+    extra = [int(share) for share in shares]
+    by_remainder = sorted(range(len(weights)), key=lambda i: shares[i] - extra[i], reverse=True)
+    for i in by_remainder[:spare - sum(extra)]:
+        extra[i] += 1
+    return [1 + n for n in extra]
+
+def count_queries(fasta_file) -> int:
+    """Number of sequences in a FASTA file, 0 if it does not exist."""
+    try:
+        with open(fasta_file) as f:
+            return sum(1 for line in f if line.startswith(">"))
+    except FileNotFoundError:
+        return 0
+
+def blast_db_size(database) -> int:
+    """Total size in bytes of a BLAST database's files, from its dbinfo record when there is one."""
+    info = utilities.read_db_info(database)
+    if info is not None and info.get("files"):
+        return sum(info["files"].values())
+    return sum(os.path.getsize(path) for path in glob.glob(f"{glob.escape(database)}.*")) or 1
+
+def blast_missing_hits(fasta_file:str, database: str, output_file : str, blast_type:str, num_threads: int = 1, cache_dir=None, aligner=None, query_map=None) -> pd.DataFrame:
+    """
+    BLAST the sequences of `fasta_file` against `database` and keep the best hit per query.
+
+    BLAST's tabular output is read from its pipe as it is produced: hits at or
+    below BLAST_MIN_PIDENT identity or under BLAST_MIN_QCOVS query coverage are
+    dropped on the spot and only the highest-bitscore hit of each query is kept,
+    so memory follows the number of queries rather than the size of the output.
+    The kept hits are written to intermediary/<output_file>_results.txt.
+
+    With a `cache_dir`, the best hit of every sequence is looked up in the BLAST
+    result cache first (see blast_cache.BlastCache); only the misses are
+    searched, and their results, hit or no hit, are added to the cache.
+
+    The search itself is run by `aligner` (BlastAligner by default, see
+    ALIGNERS); programs the aligner does not support fall back to BLAST.
+
+    Returns one row per hAMRonize row with a hit, indexed by the row number,
+    with the reference_number (ARO accession) and reference_name of the CARD
+    subject. With a `query_map` ({query id: [row index, ...]}, see
+    utilities.make_fasta_file) the hit of each query is copied to every row it
+    stands for; otherwise the row number is the number that starts the query id.
+    """
+    if aligner is None or not aligner.supports(blast_type):
+        aligner = BlastAligner()
+    queries = read_queries(fasta_file)
+    cache = blast_cache.open_blast_cache(cache_dir, database, aligner.cache_key(blast_type), BLAST_MIN_PIDENT, BLAST_MIN_QCOVS)
+    cached, misses = cache.lookup(queries) if cache is not None else ({}, queries)
+    logger.info(
+        f"> {blast_type.upper()} {len(queries)} AMR hits against {output_file} DB ({aligner.name}, {len(cached)} cached)")
+
+    hits = {query_id: hit for query_id, hit in cached.items() if hit is not None}
+    if misses:
+        query_file = fasta_file
+        if cached:
+            query_file = f"intermediary/{output_file}_queries.fasta"
+            with open(query_file, "w") as f:
+                f.writelines(f">{query_id}\n{sequence}\n" for query_id, sequence in misses.items())
+
+        searched = aligner.search(blast_type, query_file, database, num_threads)
+        if cache is not None:
+            cache.store(misses, searched)
+        hits.update(searched)
+
+    blast_df = pd.DataFrame([(query_id, *hit) for query_id, hit in hits.items()], columns=BLAST_COLUMNS)
+    blast_df = blast_df.sort_values(by=['qseqid'], ascending=False)
+    blast_df.to_csv(f"intermediary/{output_file}_results.txt", sep="\t", header=False, index=False)
+
+    if query_map is not None:
+        # Fan each hit out to every row sharing the query's sequence
+        positions = [(row, i) for i, query_id in enumerate(blast_df["qseqid"]) for row in query_map.get(query_id, [])]
+        blast_df = blast_df.iloc[[i for _, i in positions]]
+        blast_df.index = pd.Index([row for row, _ in positions], dtype=int)
+    else:
+        # The number before the first "_" of the query id is the hAMRonize row
+        blast_df.index = pd.Index([int(query_id.split("_", 1)[0]) for query_id in blast_df["qseqid"]], dtype=int)
+    references = [parse_card_subject(sseqid, stitle) for sseqid, stitle in zip(blast_df["sseqid"], blast_df["stitle"])]
+    blast_df['reference_number'] = [reference_number for reference_number, _ in references]
+    blast_df['reference_name'] = [reference_name for _, reference_name in references]
     logger.info("    ... BLAST Complete.")
 
-    
     return blast_df
 
+def stream_best_hits(blast_command) -> dict:
+    """
+    Run an aligner with BLAST_COLUMNS tabular output on its stdout and return {query id: best hit}.
+
+    Each hit is a tuple of blast_cache.HIT_COLUMNS values. A hit replaces the
+    kept one only with a strictly higher bitscore, so ties keep the aligner's order.
+    """
+    pident_at = BLAST_COLUMNS.index("pident")
+    qcovs_at = BLAST_COLUMNS.index("qcovs")
+    bitscore_at = BLAST_COLUMNS.index("bitscore")
+    converters = [BLAST_COLUMN_TYPES.get(column, int) for column in BLAST_COLUMNS]
+
+    best = {}
+    with subprocess.Popen(blast_command, stdout=subprocess.PIPE, text=True) as process:
+        for line in process.stdout:
+            # stitle is last, so splitting on tabs never breaks up a description.
+            fields = line.rstrip("\n").split("\t", len(BLAST_COLUMNS) - 1)
+            if len(fields) < len(BLAST_COLUMNS):
+                continue
+            if float(fields[pident_at]) <= BLAST_MIN_PIDENT or float(fields[qcovs_at]) < BLAST_MIN_QCOVS:
+                continue
+            query_id = fields[0]
+            kept = best.get(query_id)
+            if kept is not None and float(fields[bitscore_at]) <= kept[bitscore_at - 1]:
+                continue
+            best[query_id] = tuple(convert(value) for convert, value in zip(converters[1:], fields[1:]))
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, blast_command)
+    return best
+
+def parse_card_subject(sseqid, stitle):
+    """
+    Return the (ARO accession, gene name) of a CARD subject, or NaN for each part not found.
+
+    CARD FASTA headers look like `gb|ACT97415.1|ARO:3002999|CblA-1 [Bacteroides uniformis]`:
+    the accession is the field starting with "ARO:" and the name is the last field
+    of the sequence id. The title is used when the id lacks the accession, as
+    with databases built with -parse_seqids.
+    """
+    fields = sseqid.split("|")
+    if not any(field.startswith("ARO:") for field in fields):
+        fields = stitle.split(" ", 1)[0].split("|")
+    reference_number = next((field for field in fields if field.startswith("ARO:")), np.nan)
+    reference_name = fields[-1] if len(fields) > 1 and fields[-1] else np.nan
+    return reference_number, reference_name
+
+def read_queries(fasta_file) -> dict:
+    """Query id (first word of the header) to sequence, for every record of a FASTA file."""
+    with open(fasta_file) as handle:
+        return {record.id: str(record.seq) for record in SeqIO.parse(handle, "fasta")}
+
+
+class BlastAligner:
+    """
+    NCBI BLAST+ backend: blastp, blastx and blastn against the databases built by utilities.validate_blast_db.
+
+    Every backend has the same interface. `supports(program)` tells whether it
+    can run a BLAST program, and `cache_key(program)` names its results in the
+    BLAST result cache. `search(program, query_file, database, threads)` returns
+    {query id: best hit}, each hit a tuple of blast_cache.HIT_COLUMNS values that
+    passed the BLAST_MIN_PIDENT and BLAST_MIN_QCOVS filters.
+    """
+    name = "blast"
+    programs = ("blastp", "blastx", "blastn")
+
+    def supports(self, program):
+        return program in self.programs
+
+    def cache_key(self, program):
+        return program
+
+    def command(self, program, query_file, database, threads):
+        return [
+            program,
+            "-query", query_file,
+            "-db", database,
+            "-outfmt", f"6 {' '.join(BLAST_COLUMNS)}",
+            "-num_threads", str(threads),
+            "-max_hsps", "1",  # Ensure only one high-scoring segment per subject
+        ]
+
+    def search(self, program, query_file, database, threads):
+        return stream_best_hits(self.command(program, query_file, database, threads))
+
+
+class DiamondAligner(BlastAligner):
+    """
+    DIAMOND backend for the protein searches, blastp and blastx.
+
+    DIAMOND has its own database format: on first use the sequences of the BLAST
+    database are dumped with blastdbcmd and indexed as `<database>.dmnd`, next to
+    the BLAST files, and rebuilt whenever the BLAST database is newer. DIAMOND
+    reports qcovhsp where BLAST reports qcovs; with one HSP per subject they agree.
+    """
+    name = "diamond"
+    programs = ("blastp", "blastx")
+
+    def cache_key(self, program):
+        return f"diamond-{diamond_version()}-{program}"
+
+    def command(self, program, query_file, database, threads):
+        columns = ["qcovhsp" if column == "qcovs" else column for column in BLAST_COLUMNS]
+        return [
+            "diamond", program,
+            "--query", query_file,
+            "--db", self.prepare(database),
+            "--outfmt", "6", *columns,
+            "--threads", str(threads),
+            "--max-hsps", "1",
+        ]
+
+    def prepare(self, database):
+        """Return the DIAMOND database of a BLAST protein database, building it if needed."""
+        dmnd = f"{database}.dmnd"
+        blast_files = glob.glob(f"{glob.escape(database)}.p*")
+        with utilities.file_lock(f"{dmnd}.lock"):
+            if os.path.exists(dmnd) and all(os.path.getmtime(dmnd) >= os.path.getmtime(path) for path in blast_files):
+                return dmnd
+            logger.info(f"    Building DIAMOND database: {dmnd}")
+            sequences = f"{database}.dmnd.fasta"
+            try:
+                subprocess.run(["blastdbcmd", "-db", database, "-entry", "all", "-out", sequences], check=True)
+                # Build under a temporary name so a failed build never looks complete.
+                subprocess.run(["diamond", "makedb", "--in", sequences, "--db", f"{dmnd}.tmp"], check=True)
+                os.replace(f"{dmnd}.tmp.dmnd", dmnd)
+            finally:
+                for leftover in [sequences, f"{dmnd}.tmp.dmnd"]:
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+        return dmnd
+
+
+class FakeAligner(BlastAligner):
+    """
+    Backend returning canned hits without running anything, for tests.
+
+    `hits` maps query ids to tuples of blast_cache.HIT_COLUMNS values; the ones
+    for queries in the searched file that pass the identity and coverage filters
+    are returned. Each search is recorded in `searches`.
+    """
+    name = "fake"
+
+    def __init__(self, hits=None):
+        self.hits = hits or {}
+        self.searches = []
+
+    def cache_key(self, program):
+        return f"fake-{program}"
+
+    def search(self, program, query_file, database, threads):
+        self.searches.append((program, query_file, database, threads))
+        queries = read_queries(query_file)
+        pident_at = blast_cache.HIT_COLUMNS.index("pident")
+        qcovs_at = blast_cache.HIT_COLUMNS.index("qcovs")
+        return {
+            query_id: hit for query_id, hit in self.hits.items()
+            if query_id in queries and hit[pident_at] > BLAST_MIN_PIDENT and hit[qcovs_at] >= BLAST_MIN_QCOVS
+        }
+
+
+# Backends selectable with --aligner.
+ALIGNERS = {"blast": BlastAligner, "diamond": DiamondAligner}
+
+@lru_cache(maxsize=None)
+def diamond_version():
+    """Return the DIAMOND version, e.g. '2.1.8', or 'unknown'."""
+    try:
+        result = subprocess.run(["diamond", "version"], capture_output=True, text=True, check=True)
+        return result.stdout.split()[-1]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        return "unknown"
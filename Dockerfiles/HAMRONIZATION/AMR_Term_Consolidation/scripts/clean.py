@@ -1,29 +1,32 @@
-from typing import Tuple
 import pandas as pd
 import logging
+from scripts import load_data
 
 logger = logging.getLogger("term_consolidation")
 
+# Columns compared when removing duplicate hits: the typed hAMRonize schema.
+DUPLICATE_KEY_COLUMNS = load_data.HAMRONIZE_COLUMNS
+
 
 # Step 2 - Clean Data
 
 
-def clean_df(hamr_output: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def clean_df(hamr_output: pd.DataFrame) -> pd.DataFrame:
     """
     Cleans and processes a hAMRonize output dataframe for consistent formatting and analysis.
 
-    This function performs several cleaning and reformatting steps on the hAMRonize output:
+    This function performs several cleaning and reformatting steps on the hAMRonize output,
+    in a single pass over the dataframe with masked, vectorized string operations:
     
-    1. Extracts rows where `analysis_software_name` is `resfinder` and `input_sequence_id` is missing.
-       - These rows are collected in `read_resfinder` and represent AMR hits generated from reads.
-    2. Extracts rows where `analysis_software_name` is `resfinder` and `input_sequence_id` is present but improperly formatted.
-       - These rows are collected in `asm_resfinder`, and the `input_sequence_id` column is reformatted to extract the true contig location.
-       - The reformatted rows are added back to the dataframe.
-    3. Extracts rows where `analysis_software_name` is `rgi`, and reformats the `input_sequence_id` column to extract the correct contig location.
+    1. Drops rows where `analysis_software_name` is `resfinder` and `input_sequence_id` is missing.
+       - These rows represent AMR hits generated from reads.
+    2. Reformats `input_sequence_id` of the remaining `resfinder` rows to the true contig location
+       (the first word of the resfinder contig description).
+    3. Reformats `input_sequence_id` of the `rgi` rows to the contig location by removing the ORF suffix.
        - Differentiates between `blast` and `diamond` hits based on the `input_file_name` column by updating `analysis_software_name` accordingly.
-    4. Removes all original `resfinder` and `rgi` rows from the dataframe.
-    5. Adds back the reformatted `asm_resfinder` and `rgi` rows.
-    6. Removes duplicate rows for a clean final dataframe.
+    4. Removes duplicate rows, comparing a 64-bit hash of the DUPLICATE_KEY_COLUMNS of each row.
+
+    Rows keep their original order and index. Categorical columns stay categorical.
 
     Args:
         hamr_output (pd.DataFrame): The hAMRonize output dataframe containing AMR analysis results.
@@ -33,77 +36,65 @@ def clean_df(hamr_output: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
             - `input_file_name`: Name of the input file used for the analysis.
 
     Returns:
-        tuple:
-            - pd.DataFrame: The cleaned and processed hAMRonize dataframe.
-            - pd.DataFrame: A dataframe (`read_resfinder`) containing rows where `resfinder` was run on reads with no contig information.
+        pd.DataFrame: The cleaned and processed hAMRonize dataframe.
 
     Notes:
         - Rows where `input_sequence_id` is reformatted include only the necessary identifiers for downstream analysis.
-        - The function prints progress at each step to track changes in the dataframe size.
+        - The function logs progress at each step to track changes in the dataframe size.
         - Duplicate rows are removed to ensure a clean dataset for further processing.
 
     Example:
-        >>> cleaned_df, read_resfinder = clean_df(hamr_output)
+        >>> cleaned_df = clean_df(hamr_output)
         >>> print(cleaned_df.shape)
         (1000, 10)
-        >>> print(read_resfinder.shape)
-        (200, 10)
     """
 
     logger.info(
         f"CLEANING HAMRONIZE DATAFRAME ---------------------------------------------------------------------------------------------------\n")
 
-    
-    # 1. Extract rows where 'resfinder' analysis was run on reads (no contig information).
-    # These rows have missing values in the 'input_sequence_id' column.
-    # read_resfinder = hamr_output[hamr_output['input_sequence_id'].isna()]
-    # logger.info(f"    Found {len(read_resfinder)} AMR hits for resfinder read analysis.")
-    
-    # 2. Extract rows where 'resfinder' analysis was run on assembled contigs.
-    # These rows have improperly formatted 'input_sequence_id', which needs reformatting.
-    # eg "CCI165_S85_contig_8 length 181163 coverage 173.9 normalized_cov 0.95" becomes "CCI165_S85_contig_8"
-    asm_resfinder = hamr_output[
-        (hamr_output['analysis_software_name']=='resfinder') & 
-        (hamr_output['input_sequence_id'].notna())
-        ]
-    logger.info(f"    Found {len(asm_resfinder)} resfinder AMR hits that need contig name reformating.")
-
-    # Reformat 'input_sequence_id' to extract the true contig name (e.g., "contig_8").
-    asm_resfinder.loc[:, 'input_sequence_id'] = asm_resfinder['input_sequence_id'].str.split().str[0]
-    
+    software = hamr_output['analysis_software_name']
+    is_resfinder = (software == 'resfinder').to_numpy()
+    is_rgi = (software == 'rgi').to_numpy()
 
-    # Step 3: Extract rows where 'rgi' analysis was run.
-    # These rows also have improperly formatted 'input_sequence_id' that needs correction.
-    # eg "CCI165_S85_contig_8_162"  becomes "CCI165_S85_contig_8"
-    rgi = hamr_output[hamr_output['analysis_software_name'] == 'rgi']
-    logger.info(f"    Found {len(rgi)} rgi AMR hits that need contig name reformating.")
-
-    # Reformat 'input_sequence_id' to remove trailing identifiers (e.g., "_162").
-    rgi.loc[:,'input_sequence_id'] = rgi['input_sequence_id'].str.split('_').str[:-1].apply(lambda x: '_'.join(x))
+    # 1. Drop 'resfinder' rows run on reads (no contig information).
+    read_resfinder = is_resfinder & hamr_output['input_sequence_id'].isna().to_numpy()
+    logger.info(f"    Found {read_resfinder.sum()} AMR hits for resfinder read analysis.")
+    if read_resfinder.any():
+        keep = ~read_resfinder
+        hamr_output = hamr_output[keep].copy()
+        is_resfinder, is_rgi = is_resfinder[keep], is_rgi[keep]
 
+    # 2-3. Reformat 'input_sequence_id' to the true contig name, only on the affected rows.
+    # eg "CCI165_S85_contig_8 length 181163 coverage 173.9 normalized_cov 0.95" becomes "CCI165_S85_contig_8"
+    # eg "CCI165_S85_contig_8_162"  becomes "CCI165_S85_contig_8"
+    logger.info(f"    Found {is_resfinder.sum()} resfinder AMR hits that need contig name reformating.")
+    logger.info(f"    Found {is_rgi.sum()} rgi AMR hits that need contig name reformating.")
+    contigs = hamr_output['input_sequence_id']
+    was_categorical = isinstance(contigs.dtype, pd.CategoricalDtype)
+    contigs = contigs.astype(object)
+    contigs[is_resfinder] = contigs[is_resfinder].str.split(n=1).str[0]
+    contigs[is_rgi] = contigs[is_rgi].str.rsplit('_', n=1).str[0]
+    hamr_output['input_sequence_id'] = contigs.astype('category') if was_categorical else contigs
 
     # 4. Differentiate RGI hits by input file type ('blast' or 'diamond') for better categorization.
     # Update 'analysis_software_name' to indicate the type of hit.
-    rgi.loc[rgi['input_file_name'].str.contains('blast', na=False), 'analysis_software_name'] = "rgi_blast"
-    rgi.loc[rgi['input_file_name'].str.contains('diamond', na=False), 'analysis_software_name'] = "rgi_diamond"
-    
-    # 5. Remove all original 'resfinder' and 'rgi' rows from the dataframe
-    # before re-adding the reformatted rows to ensure clean data.
-    logger.info(f"    # Rows before deleting resfinder and rgi rows: {len(hamr_output)}")
-    hamr_output = hamr_output[hamr_output['analysis_software_name']!='resfinder']
-    hamr_output = hamr_output[hamr_output['analysis_software_name']!='rgi']
-    logger.info(f"    # Rows after deleting resfinder and rgi rows: {len(hamr_output)}")
-    
-    # 6. Add the reformatted 'asm_resfinder' and 'rgi' rows back into the dataframe.
-    hamr_output = pd.concat([hamr_output,asm_resfinder])
-    hamr_output = pd.concat([hamr_output,rgi])
-    logger.info(f"    # Rows after adding new input_sequence_names resfinder and rgi: {len(hamr_output)}")
-
-    # 7. Remove any duplicate rows to ensure uniqueness.
-    hamr_output.drop_duplicates(inplace=True)
+    if isinstance(hamr_output['analysis_software_name'].dtype, pd.CategoricalDtype):
+        hamr_output['analysis_software_name'] = hamr_output['analysis_software_name'].cat.add_categories(
+            [name for name in ['rgi_blast', 'rgi_diamond'] if name not in hamr_output['analysis_software_name'].cat.categories])
+    input_files = hamr_output['input_file_name']
+    hamr_output.loc[is_rgi & input_files.str.contains('blast', na=False).to_numpy(dtype=bool), 'analysis_software_name'] = "rgi_blast"
+    hamr_output.loc[is_rgi & input_files.str.contains('diamond', na=False).to_numpy(dtype=bool), 'analysis_software_name'] = "rgi_diamond"
+    logger.info(f"    # Rows after reformating resfinder and rgi rows: {len(hamr_output)}")
+
+    # 5. Remove any duplicate rows to ensure uniqueness.
+    key_columns = [column for column in DUPLICATE_KEY_COLUMNS if column in hamr_output.columns]
+    row_hashes = pd.util.hash_pandas_object(hamr_output[key_columns], index=False)
+    duplicated = row_hashes.duplicated().to_numpy()
+    if duplicated.any():
+        hamr_output = hamr_output.loc[~duplicated].copy()
     logger.info(f"    # Rows after removing duplicates: {len(hamr_output)}")
 
     logger.info("... Done cleaning.")
 
-    # Return the cleaned dataframe and the extracted read-only resfinder rows.
+    # Return the cleaned dataframe.
     return hamr_output #, read_resfinder
@@ -0,0 +1,302 @@
+import logging
+import mmap
+import os
+import re
+from Bio import bgzf
+
+logger = logging.getLogger("term_consolidation")
+
+
+class FastaIndexEntry:
+    """Location of one FASTA record, mirroring a samtools .fai line."""
+    __slots__ = ("name", "length", "offset", "linebases", "linewidth", "end")
+
+    def __init__(self, name, length, offset, linebases, linewidth, end=None):
+        self.name = name
+        self.length = length        # Number of residues in the record
+        self.offset = offset        # Offset (or BGZF virtual offset) of the first residue
+        self.linebases = linebases  # Residues per full line, 0 when line lengths are irregular
+        self.linewidth = linewidth  # Bytes per full line, including the newline
+        self.end = end              # Offset just past the record, only kept for irregular records
+
+
+class IndexedFasta:
+    """
+    Random access to an assembly FASTA through a faidx-style offset index.
+
+    Only the index (name, length, offset, line layout) is held in memory. Plain
+    files are memory-mapped and a region is located with the same arithmetic as
+    `samtools faidx`, so fetching a few genes never reads the other contigs.
+    BGZF-compressed files (`bgzip`) are read through their virtual offsets.
+
+    The index is saved next to the FASTA as `<file>.fai` when possible and
+    reused while it is newer than the FASTA. Keys are the first word of each
+    header, the same as `SeqIO.to_dict`.
+
+    Example:
+        >>> assembly = IndexedFasta("assembly.fasta")
+        >>> assembly.fetch("contig_1", 100, 160)
+        b'ATGAAA...'
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.is_bgzf = is_bgzf(file)
+        self._handle = None
+        self._mmap = None
+
+        if self.is_bgzf:
+            self._handle = bgzf.BgzfReader(file, "rb")
+            self.index = build_bgzf_index(self._handle)
+        else:
+            self.index = read_fai(file) or build_index(file)
+            self._handle = open(file, "rb")
+            if os.path.getsize(file) > 0:
+                self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def get_length(self, name):
+        return self.index[name].length
+
+    def fetch(self, name, start, end) -> bytes:
+        """Return residues [start, end) of a record, clamped to the record like a Python slice."""
+        entry = self.index[name]
+        start = max(0, min(int(start), entry.length))
+        end = max(0, min(int(end), entry.length))
+        if start >= end:
+            return b""
+
+        if not entry.linebases:
+            # Irregular line lengths: read the whole record and slice.
+            raw = self._read(entry, 0, entry.end - entry.offset)
+            return raw.replace(b"\r", b"").replace(b"\n", b"")[start:end]
+
+        line_start, col_start = divmod(start, entry.linebases)
+        line_end, col_end = divmod(end, entry.linebases)
+        first = line_start * entry.linewidth + col_start
+        last = line_end * entry.linewidth + col_end
+        raw = self._read(entry, first, last - first)
+        if entry.linewidth == entry.linebases + 1:
+            return raw.replace(b"\n", b"")
+        return raw.replace(b"\r", b"").replace(b"\n", b"")
+
+    def _read(self, entry, skip, size) -> bytes:
+        """Read `size` bytes starting `skip` bytes into a record's sequence block."""
+        if self.is_bgzf:
+            # Virtual offsets cannot be added to, so seek to the record and read forward.
+            self._handle.seek(entry.offset)
+            if skip:
+                self._handle.read(skip)
+            return self._handle.read(size)
+        start = entry.offset + skip
+        return self._mmap[start:start + size]
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_bgzf(file) -> bool:
+    """Check for a gzip header carrying the BGZF 'BC' extra subfield."""
+    with open(file, "rb") as f:
+        magic = f.read(18)
+    if magic[:2] != b"\x1f\x8b":
+        return False
+    if magic[3] & 4 and magic[12:14] == b"BC":
+        return True
+    raise ValueError(f"{file} is gzip but not BGZF compressed; decompress it or recompress it with bgzip.")
+
+def finish_entry(entry, line_lengths) -> bool:
+    """Fill in length and line layout of a record; return False if its lines are irregular."""
+    while line_lengths and line_lengths[-1][0] == 0:
+        line_lengths.pop()  # Blank lines between records
+    entry.length = sum(n for n, _ in line_lengths)
+    if line_lengths:
+        entry.linebases, entry.linewidth = line_lengths[0]
+    # Every line but the last must have the same length for offset arithmetic to work.
+    if any(lengths != line_lengths[0] for lengths in line_lengths[:-1]) or \
+            (len(line_lengths) > 1 and line_lengths[-1][0] > line_lengths[0][0]):
+        entry.linebases = 0
+        return False
+    return True
+
+def build_index(file) -> dict:
+    """Scan a plain FASTA once and record where every sequence starts and how its lines are laid out."""
+    index = {}
+    regular = True
+    entry = None
+    line_lengths = []
+
+    with open(file, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.startswith(b">"):
+                if entry is not None and not finish_entry(entry, line_lengths):
+                    entry.end = offset
+                    regular = False
+                name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ""
+                if name in index:
+                    raise ValueError(f"Duplicate sequence name in {file}: {name}")
+                entry = FastaIndexEntry(name, 0, offset + len(line), 0, 0)
+                index[name] = entry
+                line_lengths = []
+            elif entry is not None:
+                line_lengths.append((len(line.rstrip(b"\r\n")), len(line)))
+            offset += len(line)
+        if entry is not None and not finish_entry(entry, line_lengths):
+            entry.end = offset
+            regular = False
+
+    if regular:
+        write_fai(file, index)
+    return index
+
+def build_bgzf_index(handle) -> dict:
+    """Index a BGZF FASTA by virtual offsets. Not persisted: samtools would also need a .gzi."""
+    index = {}
+    entry = None
+    line_lengths = []
+
+    def finish(entry, line_lengths):
+        if entry is not None and not finish_entry(entry, line_lengths):
+            # Only the byte count matters here: _read() seeks to the record and reads forward.
+            entry.end = entry.offset + sum(w for _, w in line_lengths)
+
+    while True:
+        line = handle.readline()
+        if not line:
+            break
+        if line.startswith(b">"):
+            finish(entry, line_lengths)
+            name = line[1:].split(None, 1)[0].decode()
+            entry = FastaIndexEntry(name, 0, handle.tell(), 0, 0)
+            index[name] = entry
+            line_lengths = []
+        elif entry is not None:
+            line_lengths.append((len(line.rstrip(b"\r\n")), len(line)))
+    finish(entry, line_lengths)
+    return index
+
+def read_fai(file):
+    """Load `<file>.fai` if it exists and is newer than the FASTA, else return None."""
+    fai = f"{file}.fai"
+    try:
+        if os.path.getmtime(fai) < os.path.getmtime(file):
+            return None
+        index = {}
+        with open(fai) as f:
+            for line in f:
+                name, length, offset, linebases, linewidth = line.rstrip("\n").split("\t")[:5]
+                index[name] = FastaIndexEntry(name, int(length), int(offset), int(linebases), int(linewidth))
+        logger.info(f"    Loaded FASTA index: {fai}")
+        return index
+    except (OSError, ValueError):
+        return None
+
+def write_fai(file, index):
+    """Persist the index in samtools .fai format; an unwritable directory is not an error."""
+    fai = f"{file}.fai"
+    try:
+        with open(fai, "w") as f:
+            for entry in index.values():
+                f.write(f"{entry.name}\t{entry.length}\t{entry.offset}\t{entry.linebases}\t{entry.linewidth}\n")
+    except OSError as e:
+        logger.info(f"    FASTA index not saved ({str(e)}); keeping it in memory.")
+
+
+# SPAdes contig headers, e.g. "NODE_12_length_48210_cov_31.4"; tools may report just "NODE_12".
+SPADES_HEADER = re.compile(r"^(NODE_\d+)_length_\d+_cov_[\d.]+(?:_ID_\d+)?$")
+
+# Where a header is split into the whole tokens a tool may report on its own.
+HEADER_TOKEN_SEPARATOR = re.compile(r"\s+|\||_length_")
+
+
+class ContigIndex:
+    """
+    Resolve the contig names reported by AMR tools to the header keys of an assembly.
+
+    Built once per assembly, so every hit is resolved with dictionary lookups
+    instead of a scan of all headers. A name is tried, in order:
+
+    1. as a header key;
+    2. as the short name of a SPAdes header ("NODE_12" for "NODE_12_length_48210_cov_31.4");
+    3. as its first word, for resfinder's "name length ... coverage ..." descriptions;
+    4. without a trailing "_<number>", for RGI's ORF suffix ("contig_8_162");
+    5. as a whole token of a header, split at whitespace, "|" and "_length_"
+       ("contig_3" for "contig_3|sample_A"), when only one header has it.
+
+    Names are never matched inside a token, so "contig_1" does not resolve to
+    "contig_10". Results are memoized per name.
+
+    Example:
+        >>> assembly = IndexedFasta("assembly.fasta")
+        >>> contigs = ContigIndex(assembly.keys())
+        >>> contigs.resolve("NODE_12_7")
+        'NODE_12_length_48210_cov_31.4'
+    """
+
+    def __init__(self, headers):
+        self.headers = list(headers)
+        self.keys = set(self.headers)
+        self.aliases = {}
+        for header in self.headers:
+            match = SPADES_HEADER.match(header)
+            if match and match.group(1) not in self.keys:
+                alias = match.group(1)
+                # An alias shared by two headers is ambiguous and left unresolved.
+                self.aliases[alias] = None if alias in self.aliases else header
+        self.tokens = {}
+        for header in self.headers:
+            for token in set(HEADER_TOKEN_SEPARATOR.split(header)):
+                if token and token != header and token not in self.keys:
+                    # A token shared by two headers is ambiguous and left unresolved.
+                    self.tokens[token] = None if token in self.tokens else header
+        self._resolved = {}
+
+    def __len__(self):
+        return len(self.headers)
+
+    def _lookup(self, name):
+        if name in self.keys:
+            return name
+        return self.aliases.get(name)
+
+    def resolve(self, name):
+        """Return the header key of contig `name`, or None if it is missing or ambiguous."""
+        if name in self._resolved:
+            return self._resolved[name]
+        header = self._lookup(name)
+        if header is None and str(name).strip():
+            first_word = str(name).split(None, 1)[0]
+            header = self._lookup(first_word)
+            if header is None:
+                stem, _, suffix = first_word.rpartition("_")
+                if stem and suffix.isdigit():
+                    header = self._lookup(stem)
+            if header is None:
+                header = self.tokens.get(first_word)
+                if header is None and first_word in self.tokens:
+                    logger.info(f"    Contig {name} matches several assembly headers; skipped as ambiguous.")
+        self._resolved[name] = header
+        return header
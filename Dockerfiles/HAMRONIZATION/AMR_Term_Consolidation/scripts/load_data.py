@@ -1,19 +1,61 @@
 import pandas as pd
 import logging
 import sys
-from Bio import SeqIO
+import os
+import pickle
+import tempfile
 import obonet
 import re
+from scripts import utilities
+from scripts.fasta_index import IndexedFasta
 
 
 logger = logging.getLogger("term_consolidation")
 
+# Bump whenever the structure of the cached ontology (graph or lookup maps) changes.
+CARD_ONTOLOGY_CACHE_VERSION = 2
+
+# Precedence of the kinds of CARD terms in the term index, lowest first. A key
+# that is both a name and a synonym resolves to the name, as in matching_to_card.
+TERM_PRIORITY = {"accession": 0, "name": 1, "synonym": 2}
+
+# Columns of the hAMRonize output read by clean_df, group_genes, card_matching and
+# term_consolidation, with their dtypes. Low-cardinality columns are categorical.
+HAMRONIZE_SCHEMA = {
+    "input_file_name": "category",
+    "input_sequence_id": "category",
+    "analysis_software_name": "category",
+    "reference_database_name": "category",
+    "reference_accession": str,
+    "gene_symbol": str,
+    "gene_name": str,
+    "input_gene_start": "float64",
+    "input_gene_stop": "float64",
+    "sequence_identity": "float64",
+}
+HAMRONIZE_COLUMNS = list(HAMRONIZE_SCHEMA)
+
 # Step 1 - Load Data
-def load_data(file) -> pd.DataFrame:
-    """Load the data from the hamronize_amr_output.tsv."""
+def load_data(file, chunksize=None, columns=HAMRONIZE_COLUMNS) -> pd.DataFrame:
+    """
+    Load the data from the hamronize_amr_output.tsv.
+
+    Only `columns` are read (all columns if None), typed with HAMRONIZE_SCHEMA.
+    With `chunksize`, the table is read that many rows at a time and the chunks
+    are combined with shared categories, which keeps peak memory close to the
+    size of the final frame for cohort-wide `hamronize summarize` tables.
+    """
     try:
-        hamr_output = pd.read_table(file)
+        usecols = None if columns is None else (lambda column: column in columns)
+        dtypes = {column: dtype for column, dtype in HAMRONIZE_SCHEMA.items() if columns is None or column in columns}
+        if chunksize:
+            chunks = pd.read_table(file, usecols=usecols, dtype=dtypes, chunksize=chunksize)
+            hamr_output = concat_categorical_chunks(chunks)
+        else:
+            hamr_output = pd.read_table(file, usecols=usecols, dtype=dtypes)
+        hamr_output = downcast_coordinates(hamr_output)
         logger.info(f"> Total genes detected by all tools: {len(hamr_output)}")
+        logger.info(f"    hAMRonize table memory usage: {hamr_output.memory_usage(deep=True).sum() / 1e6:.1f} MB")
         return hamr_output
     except FileNotFoundError:
         logger.error(f"File not found: {file}")
@@ -22,11 +64,32 @@ def load_data(file) -> pd.DataFrame:
         logger.error(f"Error loading file {file}: {str(e)}")
         sys.exit(1)
 
-def load_assembly(file) -> pd.DataFrame:
-    """Load the data from the hamronize_amr_output.tsv."""
+def concat_categorical_chunks(chunks) -> pd.DataFrame:
+    """Concatenate chunks read with categorical dtypes without falling back to object columns."""
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame(columns=HAMRONIZE_COLUMNS)
+    categorical = [column for column, dtype in chunks[0].dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+    for column in categorical:
+        # Each chunk infers its own categories; give every chunk the union so concat keeps the dtype.
+        categories = pd.api.types.union_categoricals([chunk[column] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+def downcast_coordinates(hamr_output) -> pd.DataFrame:
+    """Gene coordinates are read as float so missing values parse; use int64 when none are missing."""
+    for column in ["input_gene_start", "input_gene_stop"]:
+        if column in hamr_output and hamr_output[column].notna().all():
+            hamr_output[column] = hamr_output[column].astype("int64")
+    return hamr_output
+
+def load_assembly(file) -> IndexedFasta:
+    """Open the assembly FASTA (plain or bgzip) through an offset index; contigs are read on demand."""
     try:
-        assembly_dict = SeqIO.to_dict(SeqIO.parse(file, "fasta"))
-        return assembly_dict
+        assembly = IndexedFasta(file)
+        logger.info(f"> Indexed {len(assembly)} contigs in assembly {file}")
+        return assembly
     except FileNotFoundError:
         logger.error(f"File not found: {file}")
         sys.exit(1)
@@ -34,7 +97,7 @@ def load_assembly(file) -> pd.DataFrame:
         logger.error(f"Error loading file {file}: {str(e)}")
         sys.exit(1)
 
-def retreive_card_ontology(file):
+def retreive_card_ontology(file, cache_dir=None):
     """
     Load and process the CARD ontology graph from an OBO file.
 
@@ -42,8 +105,14 @@ def retreive_card_ontology(file):
     extracts mappings of IDs to names, names to IDs, and synonyms to IDs,
     and cleans up the synonym terms for consistent use.
 
+    When `cache_dir` is given, the parsed graph and lookup maps are pickled
+    there under the SHA-256 of the OBO file. Later runs against the same CARD
+    release load the pickle instead of re-parsing; a new release (different
+    content hash) or a new cache version triggers a rebuild.
+
     Args:
         url (str): Path to the OBO file containing the CARD ontology.
+        cache_dir (str, optional): Directory holding compiled ontology caches. Disabled if None.
 
     Returns:
         tuple: A tuple containing:
@@ -51,6 +120,8 @@ def retreive_card_ontology(file):
             - id_to_name (dict): A dictionary mapping ontology IDs to their corresponding names.
             - name_to_id (dict): A dictionary mapping names to their corresponding ontology IDs.
             - synonym_to_id (dict): A dictionary mapping cleaned synonym terms to their corresponding ontology IDs.
+            - term_index (dict): Normalized accession, name and synonym keys mapped to
+              (ontology ID, term kind, priority), see build_term_index.
     
     Notes:
         - Synonym terms are cleaned by removing metadata like 'EXACT' or 'CARD_Short_Name'.
@@ -58,11 +129,65 @@ def retreive_card_ontology(file):
         - The ontology graph is built using the `obonet` library.
 
     Example:
-        >>> graph, id_to_name, name_to_id, synonym_to_id = retreive_card_ontology('/path/to/aro.obo')
+        >>> graph, id_to_name, name_to_id, synonym_to_id, term_index = retreive_card_ontology('/path/to/aro.obo')
         >>> print(id_to_name['ARO:0000001'])
         'Beta-lactamase'
 
     """
+    if cache_dir is None:
+        return build_card_ontology(file)
+
+    checksum = utilities.file_checksum(file)
+    cache_file = os.path.join(cache_dir, f"card_ontology_v{CARD_ONTOLOGY_CACHE_VERSION}_{checksum}.pkl")
+
+    ontology = load_card_ontology_cache(cache_file, checksum)
+    if ontology is not None:
+        logger.info(f"  > CARD ontology loaded from cache: {cache_file}")
+        return ontology
+
+    ontology = build_card_ontology(file)
+    save_card_ontology_cache(cache_file, checksum, ontology)
+    return ontology
+
+def load_card_ontology_cache(cache_file, checksum):
+    """Return the cached (graph, id_to_name, name_to_id, synonym_to_id, term_index) tuple, or None if missing or stale."""
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+    except Exception as e:
+        logger.warning(f"    Ignoring unreadable CARD ontology cache {cache_file}: {str(e)}")
+        return None
+
+    if (cached.get("version") != CARD_ONTOLOGY_CACHE_VERSION
+            or cached.get("checksum") != checksum
+            or cached.get("obonet_version") != obonet.__version__):
+        logger.info(f"    CARD ontology cache is stale: {cache_file}")
+        return None
+    return cached["ontology"]
+
+def save_card_ontology_cache(cache_file, checksum, ontology):
+    """Atomically write the compiled ontology so concurrent readers never see a partial file."""
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        payload = {
+            "version": CARD_ONTOLOGY_CACHE_VERSION,
+            "checksum": checksum,
+            "obonet_version": obonet.__version__,
+            "ontology": ontology,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_file)
+        logger.info(f"  > CARD ontology cache saved: {cache_file}")
+    except OSError as e:
+        # A read-only or full cache directory should never fail the run.
+        logger.warning(f"    Could not save CARD ontology cache {cache_file}: {str(e)}")
+
+def build_card_ontology(file):
+    """Parse the OBO file and build the graph and lookup maps (see retreive_card_ontology)."""
     # Load the ontology graph
     # url = '/Users/dmatute/Documents/CAMRA/lib/card_database/card_ontology/aro.obo'
     graph = obonet.read_obo(file)
@@ -102,4 +227,65 @@ def retreive_card_ontology(file):
             for synonym in data['synonym']:
                 synonym_to_id[synonym] = node_id
 
-    return graph, id_to_name, name_to_id, synonym_to_id
\ No newline at end of file
+    term_index = build_term_index(id_to_name, synonym_to_id)
+    return graph, id_to_name, name_to_id, synonym_to_id, term_index
+
+def normalize_term(term):
+    """Normalize a gene symbol, gene name or CARD term for lookups: stripped and lowercased."""
+    if not isinstance(term, str):
+        return None
+    return term.strip().lower()
+
+def normalize_accession(accession):
+    """Normalize an ARO accession with or without its 'ARO:' prefix, e.g. '3000796' -> 'aro:3000796'."""
+    key = normalize_term(accession)
+    if key is None:
+        return None
+    return "aro:" + key.removeprefix("aro:")
+
+def build_term_index(id_to_name, synonym_to_id) -> dict:
+    """
+    Build a single lookup index over every CARD accession, name and synonym.
+
+    Each normalized key maps to (ontology ID, term kind, priority), with kinds and
+    priorities from TERM_PRIORITY. Accession keys carry an 'aro:' prefix, so they
+    cannot collide with names. When a key has several entries the lowest priority
+    wins, and the last one seen wins a tie, like the dictionaries it replaces.
+    """
+    term_index = {}
+
+    def add(key, node_id, kind):
+        if key is None:
+            return
+        entry = (node_id, kind, TERM_PRIORITY[kind])
+        if key not in term_index or entry[2] <= term_index[key][2]:
+            term_index[key] = entry
+
+    for node_id in id_to_name:
+        add(normalize_accession(node_id), node_id, "accession")
+    for synonym, node_id in synonym_to_id.items():
+        add(normalize_term(synonym), node_id, "synonym")
+    for node_id, name in id_to_name.items():
+        add(normalize_term(name), node_id, "name")
+    return term_index
+
+def lookup_terms(values: pd.Series, term_index: dict, kinds=("name", "synonym"), accession=False) -> pd.DataFrame:
+    """
+    Resolve a whole column against the term index in one pass.
+
+    The column is factorized first, so each distinct value is normalized and
+    looked up once and the result is broadcast back with its codes; categorical
+    columns reuse their categories. Entries whose kind is not in `kinds` are
+    dropped. Returns a frame aligned on `values.index` with card_id, match_kind
+    and priority columns, NaN where nothing matched.
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    # Same normalizers as build_term_index; non-string values map to None and match nothing.
+    keys = pd.Series(uniques, dtype=object).map(normalize_accession if accession else normalize_term)
+    entries = keys.map(term_index).dropna()
+    table = pd.DataFrame(entries.tolist(), index=entries.index, columns=["card_id", "match_kind", "priority"])
+    table = table[table["match_kind"].isin(kinds)]
+    # Code -1 (missing value) is absent from the table and comes back as NaN.
+    hits = table.reindex(codes)
+    hits.index = values.index
+    return hits
@@ -1,6 +1,7 @@
 import pandas as pd
+import numpy as np
 import logging
-from itertools import combinations
+from scipy import sparse
 
 logger = logging.getLogger("term_consolidation")
 
@@ -18,91 +19,106 @@ def create_matching_hit_matix (df: pd.DataFrame) -> pd.DataFrame:
     Creates a matrix that counts how often each pair of tool-database combinations 
     is observed within the same term consolidation group. The result can be used 
     for visualization (e.g., heatmaps).
+
+    The counts come from a sparse loci group x permutation incidence matrix M:
+    entry (i, j) of M.T @ M is the number of loci groups found by both
+    permutation i and permutation j.
     '''
+    permutations = df['permutations']
+    if not isinstance(permutations.dtype, pd.CategoricalDtype):
+        permutations = permutations.astype(pd.CategoricalDtype(
+            pd.Index(permutations.dropna().unique(), dtype=object, tupleize_cols=False)))
+    categories = permutations.cat.categories
+
+    # Incidence matrix: one row per loci group, one column per permutation, 1 if the group has a hit from it.
+    permutation_codes = permutations.cat.codes.to_numpy()
+    loci_codes, loci = pd.factorize(df['loci_groups'])
+    found = permutation_codes >= 0
+    incidence = sparse.csr_matrix(
+        (np.ones(found.sum(), dtype=np.int64), (loci_codes[found], permutation_codes[found])),
+        shape=(len(loci), len(categories)))
+    incidence.data[:] = 1  # Several hits of one permutation in a group count once.
+    concurrence = (incidence.T @ incidence).tocoo()
+
+    # Keep each unordered pair once, as (smaller, larger) permutation like a sorted tuple key.
+    rank = np.empty(len(categories), dtype=np.int64)
+    rank[sorted(range(len(categories)), key=lambda code: categories[code])] = np.arange(len(categories))
+    upper = rank[concurrence.row] < rank[concurrence.col]
     
-    # For each loci group all the software/db associated to the loci. 
-    grouped : pd.Series = df.groupby('loci_groups')['permutations'].apply(list)
-    
-    # Generate all combinations of tool-database pairs for each group
-    pair_counts : dict = {}
-    for pairs in grouped:
-        unique_pairs = list(set(pairs))  # Remove duplicates in the same group
-        for pair1, pair2 in combinations(unique_pairs,2):  # Find all the combinations of unique_pairs
-            key : tuple = tuple(sorted([pair1, pair2]))  # Ensure order-independent keys # Make each combination a key 
-            pair_counts[key] : int = pair_counts.get(key, 0) + 1 # For this key in the pair_count dictionary add +1 every time a loci exhibits this combination
-    
-    # Convert pair_counts dictionary to a DataFrame
-    pair_counts_df : pd.DataFrame = pd.DataFrame(pair_counts.items(), columns=['pair', 'count'])
+    # Convert pair counts to a DataFrame
+    pair_counts_df : pd.DataFrame = pd.DataFrame({
+        'count': concurrence.data[upper].astype(np.int64),
+        'tool_db_1': [categories[code] for code in concurrence.row[upper]],
+        'tool_db_2': [categories[code] for code in concurrence.col[upper]],
+    })
 
     # Make Heatmap
-    # Split pairs into separate columns for clarity (optional)
     if len(pair_counts_df) > 0:
-        pair_counts_df[['tool_db_1', 'tool_db_2']] = pd.DataFrame(pair_counts_df['pair'].tolist(), index=pair_counts_df.index)
-        pair_counts_df.drop(columns='pair', inplace=True)
-    
     # Reshape into a matrix format (pivot)
         matrix_df = pair_counts_df.pivot(index='tool_db_1', columns='tool_db_2', values='count').fillna(0)
         return matrix_df  
     else:
-        return pair_counts_df  
+        return pd.DataFrame(columns=['pair', 'count'])
         
 def find_frequencies (df: pd.DataFrame) -> pd.DataFrame:   
     
     '''
     Analyzes the frequency of each tool-database combination (permutation) and 
     the frequency of unique hits within these combinations.
+
+    Both counts come from one groupby over the permutation codes; a unique hit
+    is a hit that is alone in its loci group. Adds the 'permutations' column
+    (see create_permutations) when it is missing.
     '''
-    
-    def count_hit_frequency_of_software_db_permutations (df: pd.DataFrame) -> pd.DataFrame:
-        # Create new 'frequency' df that value counts the permutations of tuple(software,database). 
-        frequency_df : pd.DataFrame = df['permutations'].value_counts().reset_index()
-        frequency_df.columns = ['permutation', 'permutation_frequency']
-        return frequency_df
-        
-    def count_unique_hit_frequency_of_software_db_permutations (df: pd.DataFrame) -> pd.DataFrame:
-        # Identify the frequency a loci group was found by a tuple(software,database)
-        group_sizes : pd.Series = df.groupby('loci_groups').size()
-        # Store the the groups that have a size == 1.
-        onehit_loci : pd.Index = group_sizes[group_sizes == 1].index 
-        # Create new 'single_groups' df that contains the rows that belong to the onehit_loci
-        onehit_loci_df = df[df['loci_groups'].isin(onehit_loci)].copy()
-
-        # Create new 'frequency' df that value counts the permutations of tuple(software,database). 
-        frequency_df = onehit_loci_df['permutations'].value_counts().reset_index()
-        frequency_df.columns = ['permutation', 'unique_hit_frequency']
-        return frequency_df
-    
-    def merge_frequency_df (all_hits_df: pd.DataFrame, single_hit_df: pd.DataFrame) -> pd.DataFrame:
-        # Merge the two dataframes on the 'permutation' column
-        combined_df = pd.merge(
-            all_hits_df,
-            single_hit_df,
-            on='permutation',
-            how='left'
-        ).fillna(0)  # Fill NaN for unique hits with 0 (no unique hits for some permutations)
-                # Ensure frequencies are integers
-        combined_df['unique_hit_frequency'] = combined_df['unique_hit_frequency'].astype(int)
-        combined_df['permutation_frequency'] = combined_df['permutation_frequency'].astype(int)
-        return combined_df
-        
-    def create_column (df: pd.DataFrame, new_column: str, func):
-        # Create a new column 'permunations'
-        df[new_column] : pd.Series = df.apply(
-            func,
-            axis=1)
-        return df 
-    
+
     if 'permutations' not in df.columns:
-        create_column(df, 'permutations', lambda row: tuple(
-                sorted([    
-                    row['analysis_software_name'], 
-                    row['reference_database_name']
-                ])))
-
-    software_db_frequency : pd.DataFrame = count_hit_frequency_of_software_db_permutations(df)    
-    software_db_frequency_uniquehit : pd.DataFrame = count_unique_hit_frequency_of_software_db_permutations (df)    
-    frequency_df : pd.DataFrame = merge_frequency_df(software_db_frequency, software_db_frequency_uniquehit)
-    return frequency_df
+        df['permutations'] = create_permutations(df)
+
+    # Size of each row's loci group, from the integer group numbers.
+    loci_codes, _ = pd.factorize(df['loci_groups'])
+    is_unique_hit = np.bincount(loci_codes)[loci_codes] == 1
+
+    counts = pd.DataFrame({'permutation': df['permutations'], 'unique_hit': is_unique_hit}).groupby(
+        'permutation', observed=True, sort=False)['unique_hit'].agg(['size', 'sum'])
+
+    frequency_df = pd.DataFrame({
+        'permutation': list(counts.index),
+        'permutation_frequency': counts['size'].to_numpy(dtype=int),
+        'unique_hit_frequency': counts['sum'].to_numpy(dtype=int),
+    })
+    # Most frequent first, like value_counts().
+    return frequency_df.sort_values('permutation_frequency', ascending=False, kind='stable').reset_index(drop=True)
+
+def create_permutations (df: pd.DataFrame) -> pd.Series:
+    '''
+    Builds the sorted (software, database) tuple of every hit as a categorical.
+
+    Each distinct software/database pair is sorted into a tuple only once; rows
+    hold small integer codes into those tuples, and reading a value still gives
+    the tuple. Rows missing either name get NaN.
+    '''
+    software_codes, software = pd.factorize(df['analysis_software_name'])
+    database_codes, database = pd.factorize(df['reference_database_name'])
+
+    # One integer per (software, database) pair; missing names (code -1) are handled below.
+    pair_codes = software_codes.astype(np.int64) * len(database) + database_codes
+    missing = (software_codes < 0) | (database_codes < 0)
+    pair_codes[missing] = -1
+    distinct_pairs, row_pairs = np.unique(pair_codes, return_inverse=True)
+
+    categories = {}
+    pair_to_category = np.full(len(distinct_pairs), -1, dtype=np.int64)
+    for position, pair in enumerate(distinct_pairs):
+        if pair < 0:
+            continue
+        permutation = tuple(sorted([software[pair // len(database)], database[pair % len(database)]]))
+        pair_to_category[position] = categories.setdefault(permutation, len(categories))
+
+    # tupleize_cols=False keeps the tuples as plain category values instead of a MultiIndex.
+    category_index = pd.Index(list(categories), dtype=object, tupleize_cols=False)
+    return pd.Series(
+        pd.Categorical.from_codes(pair_to_category[row_pairs.ravel()], categories=category_index),
+        index=df.index)
 
 def match_metadata (df:pd.DataFrame, column:str):
     return df[column].value_counts(dropna=False).to_markdown()
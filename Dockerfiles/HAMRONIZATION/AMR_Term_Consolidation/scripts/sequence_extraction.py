@@ -0,0 +1,145 @@
+import logging
+import numpy as np
+from Bio.Seq import Seq
+from Bio.Data import CodonTable, IUPACData
+
+logger = logging.getLogger("term_consolidation")
+
+# Residues per FASTA line, the same as SeqIO.write.
+FASTA_LINE_WIDTH = 60
+
+# Bacterial, archaeal and plant plastid code, used for every CARD protein search.
+GENETIC_CODE = 11
+
+
+def _complement_table() -> bytes:
+    """IUPAC DNA complement, upper and lower case, with U read as T (same as Bio.Seq.reverse_complement)."""
+    complement = dict(IUPACData.ambiguous_dna_complement)
+    complement["U"] = complement["T"]
+    keys = "".join(complement).encode("ascii")
+    values = "".join(complement.values()).encode("ascii")
+    return bytes.maketrans(keys + keys.lower(), values + values.lower())
+
+DNA_COMPLEMENT = _complement_table()
+
+# Base -> 2-bit code (T and U share one). Any other byte gets 64, which pushes
+# its codon's index past the 64 unambiguous codons; those are translated one by one.
+BASE_CODES = np.full(256, 64, dtype=np.intp)
+for _base, _code in {"A": 0, "C": 1, "G": 2, "T": 3, "U": 3}.items():
+    BASE_CODES[ord(_base)] = BASE_CODES[ord(_base.lower())] = _code
+
+# Markers in the raw translation: a codon still to resolve, and a codon Biopython rejects.
+AMBIGUOUS = 0
+INVALID = 1
+AMBIGUOUS_BYTE = bytes([AMBIGUOUS])
+INVALID_BYTE = bytes([INVALID])
+
+def _codon_lookup(table_id) -> np.ndarray:
+    """Amino acid byte of each codon index 16*first + 4*second + third; AMBIGUOUS past the 64 unambiguous codons."""
+    table = CodonTable.unambiguous_dna_by_id[table_id]
+    lookup = np.full(64 * 21 + 1, AMBIGUOUS, dtype=np.uint8)
+    for i in range(64):
+        codon = "ACGT"[i // 16] + "ACGT"[i // 4 % 4] + "ACGT"[i % 4]
+        lookup[i] = ord("*") if codon in table.stop_codons else ord(table.forward_table[codon])
+    return lookup
+
+CODON_LOOKUP = _codon_lookup(GENETIC_CODE)
+
+# Translations of ambiguous codons (N, IUPAC codes, gaps), INVALID when Biopython rejects the codon.
+_ambiguous_codons = {}
+
+
+def reverse_complement(sequence: bytes) -> bytes:
+    """Reverse complement of a DNA sequence, keeping the case of every base."""
+    return sequence.translate(DNA_COMPLEMENT)[::-1]
+
+def translate(sequence: bytes, to_stop=False) -> bytes:
+    """
+    Translate a DNA sequence with genetic code 11, one NumPy lookup for all codons.
+
+    The result is the same as Seq.translate(table=11): a trailing partial
+    codon is ignored, stops are "*", ambiguous codons are translated as
+    Biopython does (X when they could be a stop), and with `to_stop`
+    translation ends before the first stop. An invalid codon raises
+    CodonTable.TranslationError unless it comes after that stop.
+    """
+    codes = BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)[:len(sequence) - len(sequence) % 3]]
+    protein = CODON_LOOKUP[codes[0::3] * 16 + codes[1::3] * 4 + codes[2::3]].tobytes()
+    if AMBIGUOUS_BYTE in protein:
+        resolved = bytearray(protein)
+        i = protein.find(AMBIGUOUS_BYTE)
+        while i != -1:
+            resolved[i] = _translate_ambiguous(sequence[3 * i:3 * i + 3])
+            i = protein.find(AMBIGUOUS_BYTE, i + 1)
+        protein = bytes(resolved)
+
+    if to_stop:
+        protein = protein.split(b"*", 1)[0]
+    if INVALID_BYTE in protein:
+        i = protein.index(INVALID_BYTE)
+        raise CodonTable.TranslationError(f"Codon '{sequence[3 * i:3 * i + 3].upper().decode()}' is invalid")
+    return protein
+
+def _translate_ambiguous(codon: bytes) -> int:
+    amino_acid = _ambiguous_codons.get(codon)
+    if amino_acid is None:
+        try:
+            amino_acid = ord(str(Seq(codon).translate(table=GENETIC_CODE)))
+        except CodonTable.TranslationError:
+            amino_acid = INVALID
+        _ambiguous_codons[codon] = amino_acid
+    return amino_acid
+
+def extract_region(assembly, contig_header, start, end):
+    """
+    Nucleotide and protein sequence of a hit, as bytes, with its "start-end" location.
+
+    Same rules as utilities.extract_sequence: a hit with start < end is read
+    on the forward strand and translated up to the first stop; a hit with
+    start > end is reverse complemented and translated through its stops.
+    Returns None when start == end.
+    """
+    if start < end:
+        nucleotide = assembly.fetch(contig_header, start, end)
+        return nucleotide, translate(nucleotide, to_stop=True), f"{start}-{end}"
+    if start > end:
+        nucleotide = reverse_complement(assembly.fetch(contig_header, end, start))
+        return nucleotide, translate(nucleotide), f"{end}-{start}"
+    return None
+
+
+class FastaStream:
+    """
+    FASTA file written one record at a time, in the layout of SeqIO.write.
+
+    The file is only created with its first record, so an empty query set
+    leaves no file behind, as before.
+
+    Example:
+        >>> with FastaStream("intermediary/missing_matches_protein.fasta") as out:
+        ...     out.write("3_abricate_card", "contig_1:100-960", b"MSIQHFRVALIPFFAAF")
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._handle = None
+
+    def write(self, record_id, description, sequence: bytes):
+        if self._handle is None:
+            self._handle = open(self.path, "wb")
+        lines = [sequence[i:i + FASTA_LINE_WIDTH] for i in range(0, len(sequence), FASTA_LINE_WIDTH)]
+        lines.append(b"")
+        self._handle.write(f">{record_id} {description}\n".encode() + b"\n".join(lines))
+        self.records += 1
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
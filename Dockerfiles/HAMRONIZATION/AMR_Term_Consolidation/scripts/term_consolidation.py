@@ -1,13 +1,45 @@
 # Data handling and analysis
 import pandas as pd
+import numpy as np
 from typing import Tuple
 from typing import List
 from collections import Counter
 import math
 from scripts import load_data
 import ast
+import sys
+import logging
+
+logger = logging.getLogger("term_consolidation")
+
+# (tool, database) tuple of every distinct permutations value, shared by all the hits carrying it.
+_tool_dbs = {}
+
+def intern_tool_db(amr_tool_db) -> tuple:
+    """
+    The interned (tool, database) pair of a permutations value.
+
+    Strings such as "('abricate', 'card')", as read back from a TSV, are
+    parsed with ast.literal_eval once per distinct value.
+    """
+    if isinstance(amr_tool_db, list):
+        amr_tool_db = tuple(amr_tool_db)
+    tool_db = _tool_dbs.get(amr_tool_db)
+    if tool_db is None:
+        parsed = ast.literal_eval(amr_tool_db) if isinstance(amr_tool_db, str) else amr_tool_db
+        tool_db = _tool_dbs[amr_tool_db] = tuple(sys.intern(value) if isinstance(value, str) else value for value in parsed)
+    return tool_db
+
+def nan_to_str(field):
+    if field:
+        return field
+    else:
+        return ""
 
 class AMR_hit:
+    __slots__ = ("amr_tool", "amr_db", "amr_gene_symbol", "amr_pident", "amr_ref_accession", "amr_stop",
+                 "amr_start", "amr_contig", "match_name", "match_ref_accession", "match_pident")
+
     def __init__(self, 
                  amr_tool_db,
                  amr_gene_symbol, 
@@ -19,16 +51,8 @@ class AMR_hit:
                  match_name,
                  match_ref_accession,
                  match_pident):
-        # Ensure amr_tool_db is treated as a tuple
-        if isinstance(amr_tool_db, str):
-            amr_tool_db = ast.literal_eval(amr_tool_db)
-        def nan_to_str(field):
-            if field:
-                return field
-            else:
-                return ""
-
-        self.amr_tool, self.amr_db = amr_tool_db  # Correct unpacking
+        # Ensure amr_tool_db is treated as a tuple, parsed once per distinct value
+        self.amr_tool, self.amr_db = intern_tool_db(amr_tool_db)  # Correct unpacking
         self.amr_gene_symbol = amr_gene_symbol
         self.amr_pident = amr_pident
         self.amr_ref_accession = amr_ref_accession
@@ -43,6 +67,8 @@ class AMR_hit:
         return f"AMR_hit({self.amr_tool}, {self.amr_db},{self.amr_gene_symbol},{self.amr_pident},{self.amr_ref_accession},{self.amr_stop},{self.amr_start}, {self.amr_contig}, {self.match_name}, {self.match_ref_accession}, {self.match_pident})"
 
 class loci_group:
+    __slots__ = ("group_id", "hits", "final_gene_info")
+
     def __init__(self, group_id: int):
         self.group_id = group_id
         self.hits: List[AMR_hit] = []
@@ -259,11 +285,204 @@ def create_loci_group_dataframe(loci_groups_dict, graph):
 
 
 def term_consolidation (input_df, graph):
-    # input_df = pd.read_csv("HARMONIZED_OUTPUT.tsv", sep = '\t')
-    # input_df.head()
+    """
+    Consolidate the hits of every loci group into one CARD term, one row per group.
+
+    Columnar version of term_consolidation_rowwise, with the same output: the
+    group's hit is chosen with vectorized group-wise reductions instead of
+    one AMR_hit per row, and only the chosen hits are turned into records.
+
+    1. A single hit is kept as is ("Single Hit"), with its CARD match if it has one.
+    2. Otherwise the candidates are the hits with a 100% CARD identity, else a
+       100% tool identity, else the highest identity of CARD or of the tools,
+       CARD winning ties. The candidates' most common accession is chosen,
+       the first one on ties, and "agreeing_hits" counts the group's hits
+       with the same CARD accession.
+    """
+    if input_df is None or input_df.empty:
+        return pd.DataFrame([])
+
+    hits = select_group_hits(input_df)
+    records = []
+    metadata_cache = {}
+    amr_info_cache = {}
+    columns = {column: input_df[column].to_numpy(dtype=object) for column in [
+        "permutations", "gene_symbol", "input_gene_stop", "input_gene_start", "input_sequence_id",
+        "sequence_identity", "reference_accession"]}
+    match_name = truthy_or_blank(input_df["card_match_name"])
+    match_ref_accession = truthy_or_blank(input_df["card_match_id"])
+    match_pident = truthy_or_blank(input_df["pident"])
+
+    def card_metadata(position):
+        key = (match_ref_accession[position], match_name[position], match_pident[position], columns["sequence_identity"][position])
+        if key not in metadata_cache:
+            metadata_cache[key] = card_match_metadata(graph, *key)
+        return metadata_cache[key]
+
+    dropped = 0
+    for position, hit_count, agreeing_hits, source in zip(hits["position"], hits["hits"], hits["agreeing_hits"], hits["source"]):
+        if position < 0:
+            dropped += 1
+            continue
+        amr_db = intern_tool_db(columns["permutations"][position])[1]
+        amr_pident = columns["sequence_identity"][position]
+        amr_ref_accession = columns["reference_accession"][position]
+
+        if source == "single":
+            record = {
+                "start": columns["input_gene_start"][position],
+                "stop": columns["input_gene_stop"][position],
+                "contig": columns["input_sequence_id"][position],
+                "hits": 1,
+                "agreeing_hits": 1,
+                "pident": amr_pident if not math.isnan(amr_pident) else 0,
+                "ref_accession": amr_ref_accession,
+                "gene_name": columns["gene_symbol"][position],
+                "database": amr_db,
+                "match_type": "Single Hit",
+            }
+            if isinstance(amr_ref_accession, str):
+                if amr_ref_accession not in amr_info_cache:
+                    amr_info_cache[amr_ref_accession] = loci_group(None).get_gene_info(graph, amr_ref_accession)
+                gene_info = dict(amr_info_cache[amr_ref_accession])
+            else:
+                gene_info = {}
+            if isinstance(match_ref_accession[position], str) and match_ref_accession[position]:
+                gene_info.update(card_metadata(position))
+            record.update(gene_info)
+        else:
+            record = {
+                "start": columns["input_gene_start"][position],
+                "stop": columns["input_gene_stop"][position],
+                "contig": columns["input_sequence_id"][position],
+                "match_type": "Multiple hits",
+                "hits": hit_count,
+                "agreeing_hits": agreeing_hits,
+            }
+            if source == "CARD" or match_name[position]:
+                record.update(card_metadata(position))
+            else:
+                record.update({"pident": amr_pident,
+                               "gene_name": columns["gene_symbol"][position],
+                               "database": amr_db,
+                               "ref_accessiong": amr_ref_accession})
+        records.append(record)
+
+    if dropped:
+        logger.warning(f"{dropped} loci groups without a consolidated match were dropped.")
+    return pd.DataFrame(records)
+
+def truthy_or_blank(column) -> np.ndarray:
+    """Column values as AMR_hit keeps them: falsy values (None, "", 0) become "", NaN is kept."""
+    values = column.to_numpy(dtype=object).copy()
+    values[[not value for value in values]] = ""
+    return values
+
+def pident_or_zero(value):
+    """float(value), or the int 0 when that fails or gives NaN, as loci_group.parse_card_metadata converts pidents."""
+    try:
+        value = float(value)
+    except ValueError:
+        return 0
+    return value if not math.isnan(value) else 0
+
+def card_match_metadata(graph, ref_accession, match_name, match_pident, amr_pident) -> dict:
+    """The fields loci_group.parse_card_metadata reports for a hit's CARD match."""
+    match_pident = pident_or_zero(match_pident)
+    amr_pident = pident_or_zero(amr_pident)
+    metadata_dict = {"pident": match_pident if match_pident > amr_pident else amr_pident,
+                     "gene_name": match_name,
+                     "database": "CARD",
+                     "ref_accession": ref_accession}
+    if ref_accession in graph.nodes:
+        node = graph.nodes[ref_accession]
+        metadata_dict.update({
+            "name_space": node.get("namespace") or None,
+            "definition": node.get("def") or None,
+            "is_a": node.get("is_a") or None,
+            "relationship": node.get("relationship") or None,
+            "synonym": node.get("synonym") or None,
+        })
+    return metadata_dict
+
+def select_group_hits(input_df) -> pd.DataFrame:
+    """
+    The hit chosen for every loci group, in order of first appearance.
+
+    Returns one row per group with the `position` of the chosen hit in
+    input_df (-1 when the group has no consolidated match), the group's
+    number of `hits`, its `agreeing_hits` and the `source` of the choice:
+    "single", "CARD" or "AMR tool".
+    """
+    group_codes, groups = pd.factorize(input_df["loci_groups"], sort=False)
+    group_count = len(groups)
+    positions = np.arange(len(input_df))
+    sizes = np.bincount(group_codes, minlength=group_count)
+
+    amr_ref_accession = input_df["reference_accession"].to_numpy(dtype=object)
+    match_ref_accession = truthy_or_blank(input_df["card_match_id"])
+    match_pident = truthy_or_blank(input_df["pident"])
+    amr_pident = pd.to_numeric(input_df["sequence_identity"], errors="coerce").to_numpy(dtype=float)
+    # CARD identities only count when they are non-blank strings, as in process_multiple_hits.
+    card_pident = np.zeros(len(input_df))
+    is_text = np.array([isinstance(value, str) and bool(value.strip()) for value in match_pident], dtype=bool)
+    card_pident[is_text] = [float(value) for value in match_pident[is_text]]
+    match_pident_value = np.array([pident_or_zero(value) for value in match_pident], dtype=float)
+
+    def group_max(values):
+        maxima = np.full(group_count, -np.inf)
+        np.maximum.at(maxima, group_codes, values)
+        return maxima
+
+    card_100 = group_max((card_pident == 100.0).astype(float)) > 0
+    amr_100 = group_max((amr_pident == 100.0).astype(float)) > 0
+    card_highest = group_max(np.nan_to_num(card_pident, nan=0.0))
+    amr_highest = group_max(np.nan_to_num(amr_pident, nan=0.0))
+
+    from_card = card_100 | (~amr_100 & (card_highest > 0) & (card_highest >= amr_highest))
+    from_amr = ~from_card & (amr_100 | (amr_highest > 0))
+    card_target = np.where(card_100, 100.0, card_highest)
+    amr_target = np.where(amr_100, 100.0, amr_highest)
+
+    # Candidate hits and the accession they vote for
+    row_from_card = from_card[group_codes]
+    candidate = np.where(row_from_card, card_pident == card_target[group_codes],
+                         from_amr[group_codes] & (amr_pident == amr_target[group_codes]))
+    vote = np.where(row_from_card, match_ref_accession, amr_ref_accession)
+    # Counter only merges NaN votes that are the same object; a NaN winner matches no hit and drops the group.
+    for i in np.flatnonzero([isinstance(value, float) and math.isnan(value) for value in vote]):
+        vote[i] = ("NaN", id(vote[i]))
+    votes = pd.DataFrame({"group": group_codes[candidate], "vote": vote[candidate], "position": positions[candidate]})
+    tally = votes.groupby(["group", "vote"], sort=False).agg(count=("position", "size"), first=("position", "min")).reset_index()
+    # Most votes, then first seen, like Counter.most_common
+    tally = tally.sort_values(["group", "count", "first"], ascending=[True, False, True], kind="stable").drop_duplicates("group")
+    most_common = np.full(group_count, np.nan, dtype=object)
+    most_common[tally["group"].to_numpy(dtype=int)] = tally["vote"].to_numpy(dtype=object)
+    row_most_common = most_common[group_codes]
+
+    # Chosen hit: the last one carrying the most common accession
+    carries = np.where(row_from_card,
+                       (match_ref_accession == row_most_common) & (match_pident_value != 0),
+                       amr_ref_accession == row_most_common)
+    chosen = np.full(group_count, -1)
+    np.maximum.at(chosen, group_codes[carries], positions[carries])
+
+    # Agreeing hits share the CARD accession of the most common accession (CARD) or of the chosen hit (AMR tool)
+    agreed_accession = np.where(from_card, most_common, match_ref_accession[np.maximum(chosen, 0)])
+    agrees = (match_ref_accession == agreed_accession[group_codes]).astype(int)
+    agreeing_hits = np.bincount(group_codes, weights=agrees, minlength=group_count).astype(int)
+
+    single = sizes == 1
+    first_position = np.full(group_count, len(input_df))
+    np.minimum.at(first_position, group_codes, positions)
+    position = np.where(single, first_position, np.where((from_card | from_amr) & (agreeing_hits > 0), chosen, -1))
+    source = np.where(single, "single", np.where(from_card, "CARD", "AMR tool"))
+    return pd.DataFrame({"position": position, "hits": sizes, "agreeing_hits": agreeing_hits, "source": source})
 
+def term_consolidation_rowwise(input_df, graph):
+    """Row-by-row consolidation through AMR_hit and loci_group objects, the reference for term_consolidation."""
     loci_groups_dict = {}  # Dictionary to store LociGroup objects
-    if input_dif is not None:
+    if input_df is not None:
         # Iterate each row in the dataframe 
         for _, row in input_df.iterrows():
             loci_id = row["loci_groups"]  # Loci group number
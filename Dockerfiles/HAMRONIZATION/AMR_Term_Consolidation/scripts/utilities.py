@@ -1,5 +1,6 @@
 import logging
 from Bio.SeqRecord import SeqRecord
+from Bio.Seq import Seq
 import pandas as pd
 from Bio import SeqIO
 import argparse
@@ -7,9 +8,31 @@ import sys
 import os
 import subprocess
 import shutil
+import hashlib
+import json
+import fcntl
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+from collections import deque
+from scripts.fasta_index import ContigIndex, IndexedFasta
+from scripts.sequence_extraction import FastaStream, extract_region
 
 logger = logging.getLogger("term_consolidation")
 
+# Hits on the same contig whose start and stop both lie within this many bp of a
+# group's first hit belong to the same loci group.
+LOCI_TOLERANCE = 50
+
+# Ways make_fasta_file can merge the hits of a loci group into one region.
+LOCUS_EXTRACTION_MODES = ["union", "consensus"]
+
+# Bump whenever the files built with each cached BLAST database change.
+BLAST_DB_CACHE_VERSION = 2
+
+# CARD match types from term matching, which BLAST hits never replace.
+EXACT_MATCH_TYPES = ['gene_symbol(SYNONYM)', 'gene_name(SYNONYM)', 'reference_accession', 'gene_symbol', 'gene_name']
+
 
 def save_file_in_subdir(subdir, filename, content):
     """
@@ -42,6 +65,21 @@ def save_file_in_subdir(subdir, filename, content):
     print(f"File saved at: {file_path}")
     return file_path
 
+def default_cache_dir():
+    """Cache directory for compiled reference data, overridable with AMR_TERM_CONSOLIDATION_CACHE."""
+    return os.environ.get(
+        "AMR_TERM_CONSOLIDATION_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "amr_term_consolidation"),
+    )
+
+def file_checksum(filepath, block_size=1 << 20):
+    """Return the SHA-256 hex digest of a file's content, read in blocks."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
 def validate_file(filepath):
     """Check if a file exists and is readable."""
     if not os.path.isfile(filepath):
@@ -50,7 +88,92 @@ def validate_file(filepath):
     else:
         logger.info(f"    Found file: {filepath}")
 
-def validate_blast_db(db_path, db_name):
+def blast_version():
+    """Return the makeblastdb version string, e.g. '2.15.0+', or 'unknown'."""
+    try:
+        result = subprocess.run(['makeblastdb', '-version'], capture_output=True, text=True, check=True)
+        return result.stdout.split()[1]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        return "unknown"
+
+@contextmanager
+def file_lock(lock_path):
+    """Hold an exclusive flock on `lock_path` for the duration of the block."""
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def write_db_info(prefix, fasta_checksum, db_type, version):
+    """Record what a BLAST database was built from, and the size of each of its files, in <prefix>.dbinfo.json."""
+    db_dir, base = os.path.split(prefix)
+    files = {
+        name: os.path.getsize(os.path.join(db_dir, name))
+        for name in os.listdir(db_dir)
+        if name.startswith(base + ".") and not name.endswith(".dbinfo.json")
+    }
+    info = {"fasta_sha256": fasta_checksum, "db_type": db_type, "blast_version": version, "files": files}
+    with open(prefix + ".dbinfo.json", "w") as f:
+        json.dump(info, f, indent=2)
+    return info
+
+def read_db_info(prefix):
+    """Return the <prefix>.dbinfo.json record written by validate_blast_db, or None."""
+    try:
+        with open(prefix + ".dbinfo.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def db_info_is_valid(prefix, fasta_checksum, db_type, version):
+    """Cheap integrity check: same source and BLAST version, and every recorded file present with its size."""
+    info = read_db_info(prefix)
+    if info is None or info.get("fasta_sha256") != fasta_checksum or \
+            info.get("db_type") != db_type or info.get("blast_version") != version or not info.get("files"):
+        return False
+    db_dir = os.path.dirname(prefix)
+    for name, size in info["files"].items():
+        path = os.path.join(db_dir, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return False
+    return True
+
+def write_sequence_index(fasta_file, prefix):
+    """Write <prefix>.seqhash.tsv: the sequence_hash and full header of every record, first header for identical sequences."""
+    index = {}
+    for record in SeqIO.parse(fasta_file, "fasta"):
+        index.setdefault(sequence_hash(record.seq), record.description)
+    with open(f"{prefix}.seqhash.tsv", "w") as f:
+        f.writelines(f"{seq_hash}\t{description}\n" for seq_hash, description in index.items())
+    logger.info(f"    Sequence index created: {prefix}.seqhash.tsv ({len(index)} sequences)")
+
+def read_sequence_index(prefix):
+    """Return {sequence hash: FASTA header} from <prefix>.seqhash.tsv, or None if there is none."""
+    try:
+        with open(f"{prefix}.seqhash.tsv") as f:
+            return dict(line.rstrip("\n").split("\t", 1) for line in f)
+    except OSError:
+        return None
+
+def sequence_hash(sequence) -> str:
+    """SHA-256 of a sequence, ignoring case."""
+    return hashlib.sha256(str(sequence).upper().encode()).hexdigest()
+
+def validate_blast_db(db_path, db_name, cache_dir=None):
+    """
+    Check the CARD FASTA file and build its BLAST database, returning the absolute database prefix.
+
+    Without `cache_dir` the database is built in the working directory as `db_name`.
+    With it, databases live in `<cache_dir>/blast_db/`, keyed by the FASTA's SHA-256,
+    the database type and the makeblastdb version, and are reused after checking
+    that every file recorded at build time is still there with its size. Next to
+    the database, <prefix>.seqhash.tsv indexes every reference sequence by its
+    hash for exact matching (see card_matching.match_exact_sequences). Builds
+    hold an exclusive file lock, so concurrent workers sharing the cache build
+    each database once and never read a half-built one.
+    """
     def is_fasta_empty(fasta_file):
         """Check if a FASTA file is empty or contains no valid sequences."""
         try:
@@ -65,22 +188,18 @@ def validate_blast_db(db_path, db_name):
         
         return True  # No valid sequences found
 
-    def run_makeblastdb(fasta_file, db_name):
+    def run_makeblastdb(fasta_file, db_type, out):
         """Run makeblastdb on the given FASTA file."""
-        if 'nucl' in db_name:
-            db_type = 'nucl'
-        elif 'prot' in db_name:
-            db_type = 'prot'
         cmd = [
             'makeblastdb',
             '-in', fasta_file,
             '-dbtype', db_type,
-            '-out', db_name
+            '-out', out
         ]
         try:
             subprocess.run(cmd, check=True)
-            logger.info(f"    BLAST database created successfuly: {db_name}")
-            print(f"BLAST database created successfully: {db_name}")
+            logger.info(f"    BLAST database created successfuly: {out}")
+            print(f"BLAST database created successfully: {out}")
         except subprocess.CalledProcessError as e:
             print(f"Error running makeblastdb: {e}")
             sys.exit(1)
@@ -93,7 +212,38 @@ def validate_blast_db(db_path, db_name):
         sys.exit(1)
     
     logger.info(f"    BLAST database is not empty: {db_path}")
-    run_makeblastdb(db_path,db_name)
+    db_type = 'nucl' if 'nucl' in db_name else 'prot'
+    fasta_checksum = file_checksum(db_path)
+    version = blast_version()
+
+    if cache_dir is None:
+        prefix = os.path.abspath(db_name)
+        run_makeblastdb(db_path, db_type, prefix)
+        write_sequence_index(db_path, prefix)
+        write_db_info(prefix, fasta_checksum, db_type, version)
+        # Absolute, so the database can be used from per-sample working directories.
+        return prefix
+
+    version_tag = "".join(c if c.isalnum() or c in ".-" else "_" for c in version)
+    entry = os.path.join(os.path.abspath(cache_dir), "blast_db", f"v{BLAST_DB_CACHE_VERSION}_{db_type}_{fasta_checksum[:20]}_{version_tag}")
+    prefix = os.path.join(entry, "db")
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+    with file_lock(entry + ".lock"):
+        if db_info_is_valid(prefix, fasta_checksum, db_type, version):
+            logger.info(f"    Reusing cached BLAST database: {prefix}")
+            return prefix
+        if os.path.exists(entry):
+            logger.info(f"    Cached BLAST database failed its integrity check, rebuilding: {entry}")
+            shutil.rmtree(entry)
+        # Build next to the final location and move it in with one rename.
+        build_dir = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix=".build_")
+        run_makeblastdb(db_path, db_type, os.path.join(build_dir, "db"))
+        write_sequence_index(db_path, os.path.join(build_dir, "db"))
+        write_db_info(os.path.join(build_dir, "db"), fasta_checksum, db_type, version)
+        os.rename(build_dir, entry)
+    return prefix
+
     """Check if a BLAST database is valid."""
     
     
@@ -166,83 +316,157 @@ def parse_arguments():
     parser.add_argument("database_prot_variant_file", help="Path to protein variant BLAST database")
     parser.add_argument("database_nucl_homolog_file", help="Path to nucleotide homolog BLAST database")
     parser.add_argument("database_nucl_variant_file", help="Path to nucleotide variant BLAST database")
+    parser.add_argument("--cache_dir", default=default_cache_dir(), help="Directory for compiled reference data caches")
+    parser.add_argument("--no_cache", action="store_true", help="Disable the reference data caches")
+    parser.add_argument("--chunksize", type=int, default=None, help="Read the hamronize output this many rows at a time")
+    parser.add_argument("--threads", type=int, default=None, help="Cores shared by the BLAST searches (default: all available)")
+    parser.add_argument("--aligner", choices=["blast", "diamond"], default="blast", help="Backend for the CARD fallback searches; DIAMOND only runs the protein searches")
+    parser.add_argument("--cascade", action="store_true", help="Run the BLAST searches one after another, skipping hits already resolved")
+    parser.add_argument("--cascade_identity", type=float, default=98.0, help="Percent identity at which a cascade search resolves a hit")
+    parser.add_argument("--cascade_coverage", type=float, default=90.0, help="Percent query coverage at which a cascade search resolves a hit")
+    parser.add_argument("--cascade_order", nargs="+", default=None, help="Order of the cascade searches, as match types (default: card_blastp_homolog ... card_blastn_variant)")
+    parser.add_argument("--locus_extraction", choices=LOCUS_EXTRACTION_MODES, default=None, help="Extract one sequence per loci group for the BLAST fallback, spanning its hits (union) or at their median coordinates (consensus)")
 
     return parser.parse_args()
 
+def parse_batch_arguments():
+    """Parse command-line arguments for the multi-sample AMR term consolidation script."""
+    parser = argparse.ArgumentParser(description="Process AMR term consolidation for many samples.")
+
+    parser.add_argument("manifest_file", help="TSV with columns hamronize_output, assembly and optionally sample")
+    parser.add_argument("ontology_file", help="Path to the ontology file")
+    parser.add_argument("database_prot_homolog_file", help="Path to protein homolog BLAST database")
+    parser.add_argument("database_prot_variant_file", help="Path to protein variant BLAST database")
+    parser.add_argument("database_nucl_homolog_file", help="Path to nucleotide homolog BLAST database")
+    parser.add_argument("database_nucl_variant_file", help="Path to nucleotide variant BLAST database")
+    parser.add_argument("--output_dir", default=".", help="Directory receiving one sub-directory per sample")
+    parser.add_argument("--workers", type=int, default=available_cores(), help="Number of samples processed in parallel")
+    parser.add_argument("--combined", action="store_true", help="Also write tables combining all samples")
+    parser.add_argument("--pooled", action="store_true", help="Pool the missing matches of all samples into one BLAST search per database")
+    parser.add_argument("--cache_dir", default=default_cache_dir(), help="Directory for compiled reference data caches")
+    parser.add_argument("--no_cache", action="store_true", help="Disable the reference data caches")
+    parser.add_argument("--chunksize", type=int, default=None, help="Read the hamronize outputs this many rows at a time")
+    parser.add_argument("--threads", type=int, default=None, help="Cores shared by the BLAST searches of each sample (default: available cores / workers, all cores with --pooled)")
+    parser.add_argument("--aligner", choices=["blast", "diamond"], default="blast", help="Backend for the CARD fallback searches; DIAMOND only runs the protein searches")
+    parser.add_argument("--cascade", action="store_true", help="Run the BLAST searches one after another, skipping hits already resolved")
+    parser.add_argument("--cascade_identity", type=float, default=98.0, help="Percent identity at which a cascade search resolves a hit")
+    parser.add_argument("--cascade_coverage", type=float, default=90.0, help="Percent query coverage at which a cascade search resolves a hit")
+    parser.add_argument("--cascade_order", nargs="+", default=None, help="Order of the cascade searches, as match types (default: card_blastp_homolog ... card_blastn_variant)")
+    parser.add_argument("--locus_extraction", choices=LOCUS_EXTRACTION_MODES, default=None, help="Extract one sequence per loci group for the BLAST fallback, spanning its hits (union) or at their median coordinates (consensus)")
+
+    return parser.parse_args()
+
+def available_cores():
+    """Number of CPUs this process may run on: its CPU affinity, capped by any cgroup CPU quota."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        cores = min(cores, quota)
+    return max(1, cores)
+
+def cgroup_cpu_limit():
+    """
+    CPU limit set on this container through cgroups, rounded up to whole cores, or None.
+
+    Reads cpu.max (cgroup v2) or cpu.cfs_quota_us / cpu.cfs_period_us (cgroup v1).
+    Docker's --cpus and Kubernetes CPU limits are set this way, while the CPU
+    affinity still lists every core of the host.
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    if quota in ("max", "-1"):
+        return None
+    try:
+        return max(1, -(-int(quota) // int(period)))
+    except (ValueError, ZeroDivisionError):
+        return None
+
 # Step 3 - Group Loci
-def group_genes (hamr_output_df):
+def group_genes (hamr_output_df, tolerance=LOCI_TOLERANCE):
     """
     Groups genes in the dataframe based on loci proximity and assigns group numbers.
 
+    A hit joins a group when it is on the same contig and its start and stop are
+    both within `tolerance` bp of the group's anchor, the first hit of the group.
+    Hits are swept per contig in (start, stop) order, so each hit only checks the
+    groups whose anchor start is within `tolerance` of its own start. Group
+    numbers follow (contig, start, stop) order and do not depend on row order.
+    Hits with a missing contig or coordinate each form their own group, numbered last.
+
     Parameters:
         hamr_output_df (pd.DataFrame): Input dataframe containing gene details.
+        tolerance (int): Allowed distance in bp between a hit and its group's anchor.
 
     Returns:
-        pd.DataFrame: Updated dataframe with a new column 'loci'.
+        pd.DataFrame: Updated dataframe with a new column 'loci_groups'.
     """
 
     logger.info(
         f"GROUPING DATAFRAME'S HITS BASED ON LOCI-----------------------------------------------------------------------------------------\n")
-    
-    # Extract working data values
-    hamr_data = hamr_output_df[['input_sequence_id','gene_symbol', 
-                                'input_gene_start', 'input_gene_stop']].values
-    
-    #list of dataframe indexes
-    gene_index = hamr_output_df.index.values # Collect the indexes
-    
-    gene_groups = {}
-    
-    # Iterate through each of the AMR hits in the DataFrame
-    for gene, idx in zip(hamr_data, gene_index):
-        # Get each gene's start and stop loction and the contig. 
-        gene_start, gene_stop = gene[2:4]
-        gene_contig = gene[0]
-    
-        #Find the ranges of the start and stop
-        range = 50
-        
-        start_1 = gene_start - range
-        start_2 = gene_start + range
-        stop_1 = gene_stop - range
-        stop_2 = gene_stop + range
-    
-        match_found = False
-        
-        # Iterate the gene_group dictionary 
-        for gene_key in gene_groups.keys():
-            # If a loci match is found append the index to the dictionary. 
-            if (gene_start >= gene_key[0] and gene_start <= gene_key[1] and 
-                gene_stop >= gene_key[2] and gene_stop <= gene_key[3] and
-                gene_contig == gene_key[4] ):
-                gene_groups[gene_key].append(idx)
-                match_found = True
+
+    # Contig codes follow the sorted contig names; missing contigs get -1.
+    contig_codes, _ = pd.factorize(hamr_output_df['input_sequence_id'], sort=True)
+    starts = hamr_output_df['input_gene_start'].to_numpy(dtype=float)
+    stops = hamr_output_df['input_gene_stop'].to_numpy(dtype=float)
+
+    groups = np.full(len(hamr_output_df), -1, dtype=np.int64)
+    valid = (contig_codes >= 0) & ~np.isnan(starts) & ~np.isnan(stops)
+
+    # Sort once by contig, start and stop; the sweep below is then linear apart from the active window.
+    order = np.flatnonzero(valid)
+    order = order[np.lexsort((stops[order], starts[order], contig_codes[order]))]
+
+    group_count = 0
+    active = deque()  # (anchor_start, anchor_stop, group) of groups that can still take hits, oldest first
+    current_contig = None
+    for position in order:
+        contig, start, stop = contig_codes[position], starts[position], stops[position]
+        if contig != current_contig:
+            active.clear()
+            current_contig = contig
+        # Anchors are created in start order; drop those too far behind to ever match again.
+        while active and active[0][0] < start - tolerance:
+            active.popleft()
+        for anchor_start, anchor_stop, group in active:
+            if abs(stop - anchor_stop) <= tolerance:
+                groups[position] = group
                 break
-                
-        # If a loci match is not found then create a new dictionayr key and let the value be the index.    
-        if not match_found:
-            gene_groups[(start_1, start_2, stop_1, stop_2, gene_contig)] = [idx]
-    
-    # Change keys to numbers from 0 to len(dictionary) - 1
-    gene_groups = {i: v for i, (k, v) in enumerate(gene_groups.items())}
-    
-    # Iterate through the dictionary and assign group numbers to the dataframe
-    for group_number, indices in gene_groups.items():
-        hamr_output_df.loc[indices, 'loci_groups'] = group_number
-    hamr_output_df['loci_groups'] = hamr_output_df['loci_groups'].astype(int)
-    logger.info(f"... Done grouping {len(hamr_output_df)} AMR hits of various tools into {len(gene_groups)} loci groups.")
+        else:
+            active.append((start, stop, group_count))
+            groups[position] = group_count
+            group_count += 1
+
+    # Hits without a location cannot match anything.
+    unplaced = np.flatnonzero(~valid)
+    groups[unplaced] = np.arange(group_count, group_count + len(unplaced))
+    group_count += len(unplaced)
+
+    hamr_output_df['loci_groups'] = groups
+    logger.info(f"... Done grouping {len(hamr_output_df)} AMR hits of various tools into {group_count} loci groups.")
     return hamr_output_df
 
 # Step 6 - BLASTp unmached hits. 
-def extract_sequence(assembly:dict, contig:str, contig_header:str, start:int, end:int, gene_name:str, count : int) :
+def extract_sequence(assembly, contig:str, contig_header:str, start:int, end:int, gene_name:str, count : int) :
     if start < end:
-        nuc_sequence = assembly[contig_header].seq[start:end]
+        nuc_sequence = Seq(assembly.fetch(contig_header, start, end))
         pro_sequence = nuc_sequence.translate(table=11,to_stop=True)
         pro_record = SeqRecord(seq=pro_sequence, id=gene_name, description=f"{contig}:{start}-{end}")
         nuc_record = SeqRecord(seq=nuc_sequence, id=gene_name, description=f"{contig}:{start}-{end}")
 
     elif start > end:
-        nuc_sequence = assembly[contig_header].seq[end:start]
+        nuc_sequence = Seq(assembly.fetch(contig_header, end, start))
         nuc_sequence = nuc_sequence.reverse_complement()
         pro_sequence = nuc_sequence.translate(table=11)
         pro_record = SeqRecord(seq=pro_sequence, id=gene_name, description=f"{contig}:{end}-{start}")
@@ -262,87 +486,147 @@ def extract_sequence(assembly:dict, contig:str, contig_header:str, start:int, en
         return None, None, None
 
 def update_df(df, subset_df, match_type) -> pd.DataFrame:
+    """
+    Merges BLAST hits into the AMR hits dataframe.
 
+    Hits are aligned with the dataframe on the index (the hAMRonize row number).
+    A hit replaces the CARD match of its row when its pident is higher than the
+    row's and the row is not already an exact term match (EXACT_MATCH_TYPES).
+    Hits for rows missing from the dataframe are appended in one concat, in
+    order of their first hit, with only that hit's pident and the match type;
+    a later hit for the same row with a higher pident also sets its CARD match.
+
+    Parameters:
+    - df (pd.DataFrame): AMR hits with card_match_* columns.
+    - subset_df (pd.DataFrame): BLAST hits with reference_number, reference_name and pident, one per index.
+    - match_type (str): Value written to card_match_type for the rows updated.
+
+    Returns:
+    - pd.DataFrame: The updated dataframe.
+    """
     # Ensure 'pident' column exists in df
     if 'pident' not in df.columns:
         df['pident'] = float()# Initialize with very low values
-    
-    # Iterate over rows in subset_df
-    for idx, row in subset_df.iterrows():
-        if idx in df.index:
-            # Compare 'pident' values
-            if (
-                row['pident'] > df.at[idx, 'pident'] and 
-                str(df.at[idx, 'card_match_type']) not in ['gene_symbol(SYNONYM)', 'gene_name(SYNONYM)', 'reference_accession', 'gene_symbol', 'gene_name']
-            ):
-                df.at[idx, 'card_match_id'] = row['reference_number']
-                df.at[idx, 'card_match_name'] = row['reference_name']  # Fixed typo
-                df.at[idx, 'pident'] = row['pident']
-                df.at[idx, 'card_match_type'] = match_type
 
-        else:
-            # If index does not exist in df, add it
-            df.loc[idx] = row[['reference_number', 'reference_name', 'pident']]
-            df.at[idx, 'card_match_type'] = match_type
-    
+    # One hit per row: the highest pident, the first one on ties, as row-by-row updates would keep.
+    order = np.argsort(-subset_df['pident'].to_numpy(dtype=float), kind='stable')
+    best = order[~subset_df.index[order].duplicated()]
+    hits = subset_df.iloc[np.sort(best)]
+
+    known = hits.index.isin(df.index)
+    matched = hits[known]
+    better = (
+        (matched['pident'].to_numpy(dtype=float) > df.loc[matched.index, 'pident'].to_numpy(dtype=float)) &
+        ~df.loc[matched.index, 'card_match_type'].astype(str).isin(EXACT_MATCH_TYPES).to_numpy()
+    )
+    updates = matched[better]
+    df.loc[updates.index, 'card_match_id'] = updates['reference_number'].to_numpy()
+    df.loc[updates.index, 'card_match_name'] = updates['reference_name'].to_numpy()
+    df.loc[updates.index, 'pident'] = updates['pident'].to_numpy()
+    df.loc[updates.index, 'card_match_type'] = match_type
+
+    # Rows missing from df are appended in order of their first hit, with only its pident.
+    # A later hit with a higher pident then replaces it, as it would an existing row's match.
+    new = subset_df[~subset_df.index.isin(df.index)]
+    if not new.empty:
+        first = new[~new.index.duplicated()]
+        best_new = hits.loc[first.index]
+        replaced = best_new['pident'].to_numpy(dtype=float) > first['pident'].to_numpy(dtype=float)
+        new_rows = pd.DataFrame({
+            'card_match_id': best_new['reference_number'].where(replaced).to_numpy(),
+            'card_match_name': best_new['reference_name'].where(replaced).to_numpy(),
+            'pident': np.where(replaced, best_new['pident'], first['pident']),
+            'card_match_type': match_type,
+        }, index=first.index)
+        df = pd.concat([df, new_rows.reindex(columns=df.columns)])
+
     return df
 
 
-def make_fasta_file(df: pd.DataFrame, assembly: dict, output_dir: str, output_prefix: str) -> None:
+def make_fasta_file(df: pd.DataFrame, assembly: IndexedFasta, output_dir: str, output_prefix: str, locus_mode=None) -> dict:
     """
     Extracts AMR sequences from an assembly and saves them as FASTA and TXT files.
 
+    Identical sequences are written once: several tools often report the same
+    locus, and each FASTA record is searched by every BLAST task. The first row
+    with a sequence names its record, and the query map records every row
+    sharing it, so results can be fanned back out (see card_matching.blast_missing_hits).
+    Nucleotide and protein sequences are collapsed separately. Contig names are
+    resolved to assembly headers through fasta_index.ContigIndex; hits on a
+    contig missing from the assembly are skipped. Sequences are sliced and
+    translated as bytes (see sequence_extraction.extract_region) and streamed
+    to the FASTA files as they are found.
+
+    With a `locus_mode`, one region is extracted per loci group instead of one
+    per row, see locus_regions; its record lists the member rows in the
+    description and the query map fans results out to all of them.
+
     Parameters:
     - df (pd.DataFrame): DataFrame containing AMR gene information.
-    - assembly (dict): Dictionary containing contig sequences.
+    - assembly (IndexedFasta): Indexed assembly, see load_data.load_assembly.
     - output_dir (str): Directory to save output files.
     - output_prefix (str): Prefix for the output files.
+    - locus_mode (str): "union" or "consensus" to extract per loci group, per row if None.
 
     Returns:
-    - None (Saves files in the specified directory)
+    - dict: Query map of each FASTA file written, {fasta path: {query id: [row index, ...]}}.
+      The maps are also saved as <output_prefix>_query_map.tsv.
     """
     
     count = 1
     logger.info(
         f"EXTRACTING AMR SEQUENCES FROM ASSEMBLY------------------------------------------------------------------------------------------\n")
 
-    nucleotide_records = []
-    protein_records = []
     metadata_list = []
+    nucleotide_queries, protein_queries = {}, {}
+    nucleotide_map, protein_map = {}, {}
 
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
-    for _, row in df.iterrows():
-        contig = row["input_sequence_id"]
-        start = row["input_gene_start"]
-        end = row["input_gene_stop"]
-        gene_name = f"{row.name}_{'_'.join(row['permutations'])}"
-
-        # Extract the contig sequence from assembly dictionary
-        for contig_header in assembly.keys():
-            if contig in contig_header:
-                pro_record, nuc_record, count = extract_sequence(assembly, contig, contig_header, start, end, gene_name, count)
-                nucleotide_records.append(nuc_record)
-                protein_records.append(pro_record)
-
-                # Collect metadata
-                metadata_list.append(f"{gene_name}\t{contig}\t{start}\t{end}")
-                break
-
     # Define file paths
     nucleotide_fasta_path = os.path.join(output_dir, f"{output_prefix}_nucleotide.fasta")
     protein_fasta_path = os.path.join(output_dir, f"{output_prefix}_protein.fasta")
     metadata_txt_path = os.path.join(output_dir, f"{output_prefix}_metadata.txt")
-
-    # Save nucleotide and protein FASTA files
-    if nucleotide_records:
-        SeqIO.write(nucleotide_records, nucleotide_fasta_path, "fasta")
-        logger.info(f"  > Nucleotide FASTA saved at {nucleotide_fasta_path}")
-
-    if protein_records:
-        SeqIO.write(protein_records, protein_fasta_path, "fasta")
-        logger.info(f"  > Protein FASTA saved at {protein_fasta_path}")
+    query_map_path = os.path.join(output_dir, f"{output_prefix}_query_map.tsv")
+    query_maps = {}
+
+    # Contig names as the tools report them, resolved to assembly headers in O(1)
+    contigs = ContigIndex(assembly.keys())
+
+    # Records are streamed to the FASTA files as they are extracted
+    with FastaStream(nucleotide_fasta_path) as nucleotide_out, FastaStream(protein_fasta_path) as protein_out:
+        regions = locus_regions(df, locus_mode) if locus_mode is not None else row_regions(df)
+        for gene_name, contig, start, end, rows in regions:
+            # Find the contig header in the assembly index
+            contig_header = contigs.resolve(contig)
+            if contig_header is None:
+                logger.info(f"    Contig {contig} of {gene_name} not found in the assembly; sequence not extracted.")
+                continue
+            extracted = extract_region(assembly, contig_header, start, end)
+            if extracted is None:
+                logger.info(f"    {count}.failed seq extract : {contig} {start}:{end}")
+                count = count + 1
+                continue
+            nucleotide, protein, location = extracted
+            logger.info(f"    {count}.successful seq extract : {contig} {start}:{end}")
+            count = count + 1
+            description = f"{contig}:{location}"
+            if locus_mode is not None:
+                description = f"{description} rows={','.join(str(row) for row in rows)}"
+            add_query(nucleotide_out, nucleotide_queries, nucleotide_map, gene_name, description, nucleotide, rows)
+            add_query(protein_out, protein_queries, protein_map, gene_name, description, protein, rows)
+
+            # Collect metadata
+            metadata_list.append(f"{gene_name}\t{contig}\t{start}\t{end}")
+
+    if nucleotide_out.records:
+        query_maps[nucleotide_fasta_path] = nucleotide_map
+        logger.info(f"  > Nucleotide FASTA saved at {nucleotide_fasta_path}: {nucleotide_out.records} unique sequences for {len(metadata_list)} hits")
+
+    if protein_out.records:
+        query_maps[protein_fasta_path] = protein_map
+        logger.info(f"  > Protein FASTA saved at {protein_fasta_path}: {protein_out.records} unique sequences for {len(metadata_list)} hits")
 
     # Save metadata TXT file
     if metadata_list:
@@ -351,6 +635,60 @@ def make_fasta_file(df: pd.DataFrame, assembly: dict, output_dir: str, output_pr
             f.write("\n".join(metadata_list))
         logger.info(f"  > Metadata TXT saved at {metadata_txt_path}")
 
+    if query_maps:
+        with open(query_map_path, "w") as f:
+            f.write("FASTA\tQuery_ID\tRow\n")
+            for fasta_path, query_map in query_maps.items():
+                for query_id, rows in query_map.items():
+                    f.writelines(f"{os.path.basename(fasta_path)}\t{query_id}\t{row}\n" for row in rows)
+        logger.info(f"  > Query map saved at {query_map_path}")
+
+    return query_maps
+
+def row_regions(df):
+    """(gene name, contig, start, end, [row]) of every row, the gene name being `<row>_<permutations>`."""
+    for row_index, contig, start, end, permutations in zip(
+            df.index, df["input_sequence_id"], df["input_gene_start"], df["input_gene_stop"], df["permutations"]):
+        yield f"{row_index}_{'_'.join(permutations)}", contig, start, end, [row_index]
+
+def locus_regions(df, mode):
+    """
+    (gene name, contig, start, end, member rows) of every loci group of `df`, see group_genes.
+
+    A group's region keeps the strand of its first row (start > end on the
+    reverse strand, as in the hAMRonize output). With mode "union" it spans
+    every member; with "consensus" its start and its end are the medians of
+    the members' starts and ends on that strand, the lower one for an even
+    count. The gene name is `<first row>_locus<group>`.
+    """
+    if mode not in LOCUS_EXTRACTION_MODES:
+        raise ValueError(f"Unknown locus extraction mode {mode}; choose from {LOCUS_EXTRACTION_MODES}")
+    for group, members in df.groupby("loci_groups", sort=False):
+        rows = members.index.tolist()
+        contig = members["input_sequence_id"].iloc[0]
+        starts = members["input_gene_start"].to_numpy()
+        ends = members["input_gene_stop"].to_numpy()
+        reverse = starts[0] > ends[0]
+        if mode == "union":
+            low = min(starts.min(), ends.min())
+            high = max(starts.max(), ends.max())
+            start, end = (high, low) if reverse else (low, high)
+        else:
+            same_strand = (starts > ends) == reverse
+            start = np.sort(starts[same_strand])[(same_strand.sum() - 1) // 2]
+            end = np.sort(ends[same_strand])[(same_strand.sum() - 1) // 2]
+        yield f"{rows[0]}_locus{group}", contig, start, end, rows
+
+def add_query(out, queries, query_map, query_id, description, sequence, rows):
+    """Write the first record of each distinct sequence to `out` (a FastaStream) and map its id to every row with that sequence."""
+    key = sequence.upper()
+    first_id = queries.get(key)
+    if first_id is None:
+        first_id = queries[key] = query_id
+        out.write(query_id, description, sequence)
+        query_map[first_id] = []
+    query_map[first_id].extend(rows)
+
 def save_intermediary_file(output_dir: str, filename: str, data):
     """
     Saves a Pandas DataFrame or raw BLAST output into an intermediary file.
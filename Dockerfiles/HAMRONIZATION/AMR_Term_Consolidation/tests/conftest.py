@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Import the pipeline modules as the scripts do, from the AMR_Term_Consolidation directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
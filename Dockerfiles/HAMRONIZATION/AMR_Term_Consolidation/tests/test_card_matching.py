@@ -0,0 +1,117 @@
+"""
+BLAST fallback searches run through card_matching.FakeAligner, without BLAST installed.
+
+Usage (from the AMR_Term_Consolidation directory):
+    python -m pytest tests
+"""
+import os
+
+import pytest
+
+from scripts import card_matching, utilities
+from scripts.card_matching import FakeAligner
+
+
+def hit(aro="ARO:3000001", name="TEM-1", pident=99.0, qcovs=100):
+    """A best hit as the aligners return it, a tuple of blast_cache.HIT_COLUMNS values."""
+    sseqid = f"gb|AAA00001.1|{aro}|{name}"
+    return (sseqid, pident, 300, 1e-50, 500.0, qcovs, f"{sseqid} [Escherichia coli]")
+
+def write_fasta(path, queries):
+    with open(path, "w") as f:
+        f.writelines(f">{query_id}\n{sequence}\n" for query_id, sequence in queries.items())
+    return str(path)
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory with the ./intermediary folder the searches write to."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("intermediary")
+    return tmp_path
+
+@pytest.fixture
+def database(workdir):
+    """Prefix of a BLAST database with a dbinfo record, so its results can be cached."""
+    prefix = str(workdir / "prot_homolog")
+    utilities.write_db_info(prefix, "0" * 64, "prot", "2.15.0")
+    return prefix
+
+
+def test_query_map_fans_hits_out_to_rows(workdir, database):
+    fasta_file = write_fasta(workdir / "queries.fasta", {"0_abricate_card": "MKAL", "1_rgi_card": "MSIQ"})
+    aligner = FakeAligner({"0_abricate_card": hit()})
+    results = card_matching.blast_missing_hits(fasta_file, database, "card_blastp_homolog", "blastp", aligner=aligner,
+                                               query_map={"0_abricate_card": [0, 3, 5], "1_rgi_card": [1]})
+    assert results.index.tolist() == [0, 3, 5]
+    assert results["reference_number"].tolist() == ["ARO:3000001"] * 3
+    assert results["reference_name"].tolist() == ["TEM-1"] * 3
+    assert aligner.searches == [("blastp", fasta_file, database, 1)]
+    assert os.path.exists("intermediary/card_blastp_homolog_results.txt")
+
+def test_row_from_query_id_without_query_map(workdir, database):
+    fasta_file = write_fasta(workdir / "queries.fasta", {"4_abricate_card": "MKAL"})
+    results = card_matching.blast_missing_hits(fasta_file, database, "card_blastp_homolog", "blastp", aligner=FakeAligner({"4_abricate_card": hit()}))
+    assert results.index.tolist() == [4]
+
+def test_identity_and_coverage_filters(workdir, database, monkeypatch):
+    monkeypatch.setattr(card_matching, "BLAST_MIN_QCOVS", 50)
+    queries = {"0_a": "MKAL", "1_a": "MSIQ", "2_a": "MHFR", "3_a": "MVAL"}
+    fasta_file = write_fasta(workdir / "queries.fasta", queries)
+    aligner = FakeAligner({
+        "0_a": hit(pident=card_matching.BLAST_MIN_PIDENT),
+        "1_a": hit(pident=card_matching.BLAST_MIN_PIDENT + 0.1),
+        "2_a": hit(qcovs=49),
+        "3_a": hit(qcovs=50),
+    })
+    results = card_matching.blast_missing_hits(fasta_file, database, "card_blastp_homolog", "blastp", aligner=aligner)
+    assert sorted(results.index) == [1, 3]
+
+def test_cache_hits_and_misses(workdir, database):
+    cache_dir = str(workdir / "cache")
+    fasta_file = write_fasta(workdir / "queries.fasta", {"0_a": "MKAL", "1_a": "MSIQ"})
+    first = FakeAligner({"0_a": hit()})
+    card_matching.blast_missing_hits(fasta_file, database, "card_blastp_homolog", "blastp", cache_dir=cache_dir, aligner=first)
+    assert len(first.searches) == 1
+
+    # Both sequences are cached, the one without a hit too: nothing is searched.
+    cached = FakeAligner()
+    results = card_matching.blast_missing_hits(fasta_file, database, "card_blastp_homolog", "blastp", cache_dir=cache_dir, aligner=cached)
+    assert cached.searches == []
+    assert results.index.tolist() == [0]
+    assert results["reference_number"].tolist() == ["ARO:3000001"]
+
+    # Only the new sequence is searched, from a FASTA file of the misses.
+    fasta_file = write_fasta(workdir / "queries.fasta", {"0_a": "MKAL", "1_a": "MSIQ", "2_a": "MHFR"})
+    partial = FakeAligner({"2_a": hit(aro="ARO:3000002", name="OXA-1")})
+    results = card_matching.blast_missing_hits(fasta_file, database, "card_blastp_homolog", "blastp", cache_dir=cache_dir, aligner=partial)
+    query_file = partial.searches[0][1]
+    assert len(partial.searches) == 1
+    assert list(card_matching.read_queries(query_file)) == ["2_a"]
+    assert sorted(zip(results.index, results["reference_name"])) == [(0, "TEM-1"), (2, "OXA-1")]
+
+def test_cache_is_kept_per_program(workdir, database):
+    cache_dir = str(workdir / "cache")
+    fasta_file = write_fasta(workdir / "queries.fasta", {"0_a": "ATGAAAGCG"})
+    card_matching.blast_missing_hits(fasta_file, database, "card_blastx_homolog", "blastx", cache_dir=cache_dir, aligner=FakeAligner({"0_a": hit()}))
+    aligner = FakeAligner()
+    card_matching.blast_missing_hits(fasta_file, database, "card_blastn_homolog", "blastn", cache_dir=cache_dir, aligner=aligner)
+    assert len(aligner.searches) == 1
+
+def test_run_blast_tasks_in_task_order(workdir, database):
+    protein = write_fasta(workdir / "protein.fasta", {"q1": "MKAL", "q2": "MSIQ"})
+    nucleotide = write_fasta(workdir / "nucleotide.fasta", {"q1": "ATGAAAGCG"})
+    tasks = [
+        (protein, "blastp", "prot_homolog", "card_blastp_homolog"),
+        (nucleotide, "blastn", "nucl_homolog", "card_blastn_homolog"),
+        (str(workdir / "missing.fasta"), "blastx", "prot_homolog", "card_blastx_homolog"),
+    ]
+    query_maps = {os.path.normpath(protein): {"q1": [0, 2], "q2": [1]}, os.path.normpath(nucleotide): {"q1": [0, 2]}}
+    aligner = FakeAligner({"q1": hit(), "q2": hit(aro="ARO:3000002", name="OXA-1", pident=80.0)})
+
+    task_results = card_matching.run_blast_tasks(tasks, {"prot_homolog": database}, threads=2, aligner=aligner, query_maps=query_maps)
+    (blastp, blastp_error), (blastn, blastn_error), (blastx, blastx_error) = task_results
+    assert blastp_error is None and blastn_error is None
+    assert sorted(zip(blastp.index, blastp["reference_name"])) == [(0, "TEM-1"), (1, "OXA-1"), (2, "TEM-1")]
+    assert sorted(blastn.index) == [0, 2]
+    assert blastx is None and isinstance(blastx_error, FileNotFoundError)
+    assert sorted(search[0] for search in aligner.searches) == ["blastn", "blastp"]
@@ -0,0 +1,40 @@
+"""
+Resolution of AMR tool contig names to assembly headers by fasta_index.ContigIndex.
+
+Usage (from the AMR_Term_Consolidation directory):
+    python -m pytest tests
+"""
+from scripts.fasta_index import ContigIndex
+
+
+def test_exact_header():
+    assert ContigIndex(["contig_1", "contig_10"]).resolve("contig_1") == "contig_1"
+
+def test_prefix_of_another_contig_is_missing():
+    contigs = ContigIndex(["contig_10", "contig_2"])
+    assert contigs.resolve("contig_1") is None
+    assert contigs.resolve("contig_1 length 181163 coverage 173.9") is None
+
+def test_spades_short_name():
+    contigs = ContigIndex(["NODE_12_length_48210_cov_31.4", "NODE_1_length_9000_cov_12.0"])
+    assert contigs.resolve("NODE_12") == "NODE_12_length_48210_cov_31.4"
+    assert contigs.resolve("NODE_1") == "NODE_1_length_9000_cov_12.0"
+
+def test_resfinder_description_and_rgi_orf_suffix():
+    contigs = ContigIndex(["CCI165_S85_contig_8", "CCI165_S85_contig_80"])
+    assert contigs.resolve("CCI165_S85_contig_8 length 181163 coverage 173.9 normalized_cov 0.95") == "CCI165_S85_contig_8"
+    assert contigs.resolve("CCI165_S85_contig_8_162") == "CCI165_S85_contig_8"
+
+def test_whole_token_of_header():
+    contigs = ContigIndex(["contig_3|sample_A", "contig_30|sample_A", "NODE_5_length_700_cov_x"])
+    assert contigs.resolve("contig_3") == "contig_3|sample_A"
+    assert contigs.resolve("NODE_5") == "NODE_5_length_700_cov_x"
+    assert contigs.resolve("sample") is None
+
+def test_token_shared_by_two_headers_is_ambiguous():
+    assert ContigIndex(["contig_3|sample_A", "contig_3|sample_B"]).resolve("contig_3") is None
+
+def test_missing_and_blank_names():
+    contigs = ContigIndex(["contig_1"])
+    assert contigs.resolve("plasmid_1") is None
+    assert contigs.resolve("") is None
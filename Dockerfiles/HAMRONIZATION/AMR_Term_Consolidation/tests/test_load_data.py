@@ -0,0 +1,34 @@
+"""
+Column lookups against the CARD term index of load_data.
+
+Usage (from the AMR_Term_Consolidation directory):
+    python -m pytest tests
+"""
+import numpy as np
+import pandas as pd
+
+from scripts import load_data
+
+ID_TO_NAME = {"ARO:3000796": "mdtF", "ARO:3000001": "TEM-1"}
+SYNONYM_TO_ID = {"yhiV": "ARO:3000796"}
+
+
+def test_names_and_synonyms():
+    term_index = load_data.build_term_index(ID_TO_NAME, SYNONYM_TO_ID)
+    hits = load_data.lookup_terms(pd.Series([" MDTF", "yhiv", "blaX", np.nan]), term_index)
+    assert hits["card_id"].tolist()[:2] == ["ARO:3000796", "ARO:3000796"]
+    assert hits["match_kind"].tolist()[:2] == ["name", "synonym"]
+    assert hits["card_id"].iloc[2:].isna().all()
+
+def test_accessions_with_and_without_prefix():
+    term_index = load_data.build_term_index(ID_TO_NAME, SYNONYM_TO_ID)
+    hits = load_data.lookup_terms(pd.Series(["3000001", "aro:3000796", "mdtF"]), term_index, kinds=("accession",), accession=True)
+    assert hits["card_id"].tolist()[:2] == ["ARO:3000001", "ARO:3000796"]
+    assert np.isnan(hits["card_id"].iloc[2])
+
+def test_column_without_strings():
+    term_index = load_data.build_term_index(ID_TO_NAME, SYNONYM_TO_ID)
+    values = pd.Series([np.nan, 3000001.0, np.nan], index=[4, 7, 9])
+    hits = load_data.lookup_terms(values, term_index, kinds=("accession",), accession=True)
+    assert hits.index.tolist() == [4, 7, 9]
+    assert hits["card_id"].isna().all()
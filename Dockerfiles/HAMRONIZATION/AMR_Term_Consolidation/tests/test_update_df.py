@@ -0,0 +1,119 @@
+"""
+Equivalence of utilities.update_df with the row-by-row merge it replaced.
+
+Usage (from the AMR_Term_Consolidation directory):
+    python -m pytest tests
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from scripts import utilities
+from scripts.utilities import EXACT_MATCH_TYPES
+
+
+def update_df_iterrows(df, subset_df, match_type) -> pd.DataFrame:
+    """The previous update_df, one iterrows/df.at update per BLAST hit."""
+    if 'pident' not in df.columns:
+        df['pident'] = float()
+    for idx, row in subset_df.iterrows():
+        if idx in df.index:
+            if (
+                row['pident'] > df.at[idx, 'pident'] and
+                str(df.at[idx, 'card_match_type']) not in ['gene_symbol(SYNONYM)', 'gene_name(SYNONYM)', 'reference_accession', 'gene_symbol', 'gene_name']
+            ):
+                df.at[idx, 'card_match_id'] = row['reference_number']
+                df.at[idx, 'card_match_name'] = row['reference_name']
+                df.at[idx, 'pident'] = row['pident']
+                df.at[idx, 'card_match_type'] = match_type
+        else:
+            df.loc[idx] = row[['reference_number', 'reference_name', 'pident']]
+            df.at[idx, 'card_match_type'] = match_type
+    return df
+
+def amr_hits(card_match_type=np.nan, pident=90.0, rows=2) -> pd.DataFrame:
+    return pd.DataFrame({
+        'gene_symbol': [f"gene_{i}" for i in range(rows)],
+        'card_match_id': ["ARO:3000001"] * rows,
+        'card_match_name': ["previous"] * rows,
+        'card_match_type': pd.Series([card_match_type] * rows, dtype=object),
+        'pident': [pident] * rows,
+    })
+
+def blast_hits(hits) -> pd.DataFrame:
+    """BLAST results from (row, reference_number, reference_name, pident) tuples."""
+    return pd.DataFrame(hits, columns=['row', 'reference_number', 'reference_name', 'pident']).set_index('row')
+
+def assert_same_update(df, subset_df, match_type="BLASTP") -> pd.DataFrame:
+    expected = update_df_iterrows(df.copy(), subset_df, match_type)
+    updated = utilities.update_df(df.copy(), subset_df, match_type)
+    pd.testing.assert_frame_equal(updated, expected)
+    return updated
+
+
+def test_higher_pident_replaces_match():
+    updated = assert_same_update(amr_hits(), blast_hits([(0, "ARO:3000002", "blast", 95.0)]))
+    assert updated.loc[0, ['card_match_id', 'card_match_name', 'pident', 'card_match_type']].tolist() == ["ARO:3000002", "blast", 95.0, "BLASTP"]
+    assert updated.loc[1, 'card_match_name'] == "previous"
+
+def test_lower_pident_is_ignored():
+    updated = assert_same_update(amr_hits(), blast_hits([(0, "ARO:3000002", "blast", 85.0)]))
+    assert updated.loc[0, 'card_match_name'] == "previous"
+
+@pytest.mark.parametrize("match_type", EXACT_MATCH_TYPES)
+def test_exact_matches_are_kept(match_type):
+    updated = assert_same_update(amr_hits(match_type, pident=0.0), blast_hits([(0, "ARO:3000002", "blast", 100.0)]))
+    assert updated.loc[0, ['card_match_name', 'card_match_type']].tolist() == ["previous", match_type]
+
+def test_tie_keeps_current_match():
+    updated = assert_same_update(amr_hits(), blast_hits([(0, "ARO:3000002", "blast", 90.0)]))
+    assert updated.loc[0, 'card_match_name'] == "previous"
+
+def test_tied_hits_keep_the_first():
+    updated = assert_same_update(amr_hits(), blast_hits([(0, "ARO:3000002", "first", 95.0), (0, "ARO:3000003", "second", 95.0)]))
+    assert updated.loc[0, 'card_match_name'] == "first"
+
+def test_best_of_several_hits_wins():
+    hits = [(0, "ARO:3000002", "low", 92.0), (0, "ARO:3000003", "best", 99.0), (0, "ARO:3000004", "middle", 95.0)]
+    updated = assert_same_update(amr_hits(), blast_hits(hits))
+    assert updated.loc[0, 'card_match_name'] == "best"
+
+def test_missing_pident_column():
+    assert_same_update(amr_hits().drop(columns='pident'), blast_hits([(0, "ARO:3000002", "blast", 95.0)]))
+
+def test_new_row_sets_only_pident_and_match_type():
+    updated = assert_same_update(amr_hits(), blast_hits([(5, "ARO:3000002", "blast", 95.0)]))
+    assert updated.loc[5, ['pident', 'card_match_type']].tolist() == [95.0, "BLASTP"]
+    assert updated.loc[5, ['gene_symbol', 'card_match_id', 'card_match_name']].isna().all()
+
+def test_new_rows_follow_first_hit_order():
+    hits = [(7, "ARO:3000002", "a", 80.0), (5, "ARO:3000003", "b", 90.0), (7, "ARO:3000004", "c", 99.0)]
+    updated = assert_same_update(amr_hits(), blast_hits(hits))
+    assert updated.index.tolist() == [0, 1, 7, 5]
+
+def test_new_row_later_higher_hit_sets_match():
+    hits = [(5, "ARO:3000002", "first", 85.0), (5, "ARO:3000003", "better", 95.0)]
+    updated = assert_same_update(amr_hits(), blast_hits(hits))
+    assert updated.loc[5, ['card_match_id', 'card_match_name', 'pident']].tolist() == ["ARO:3000003", "better", 95.0]
+
+def test_new_row_best_first_hit_keeps_no_match():
+    hits = [(5, "ARO:3000002", "first", 95.0), (5, "ARO:3000003", "lower", 85.0), (5, "ARO:3000004", "tied", 95.0)]
+    updated = assert_same_update(amr_hits(), blast_hits(hits))
+    assert updated.loc[5, 'pident'] == 95.0
+    assert updated.loc[5, ['card_match_id', 'card_match_name']].isna().all()
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random_tables(seed):
+    rng = np.random.default_rng(seed)
+    rows = int(rng.integers(1, 8))
+    match_types = np.array(EXACT_MATCH_TYPES + ["BLASTP", np.nan], dtype=object)
+    df = pd.DataFrame({
+        'gene_symbol': [f"gene_{i}" for i in range(rows)],
+        'card_match_id': rng.choice(np.array(["ARO:3000001", "ARO:3000002", np.nan], dtype=object), rows),
+        'card_match_name': rng.choice(np.array(["a", "b", np.nan], dtype=object), rows),
+        'card_match_type': pd.Series(rng.choice(match_types, rows), dtype=object),
+        'pident': rng.choice([np.nan, 80.0, 95.0, 100.0], rows),
+    })
+    hit_count = int(rng.integers(1, 8))
+    hits = zip(rng.integers(0, rows + 3, hit_count), rng.integers(10, 20, hit_count), rng.integers(0, 9, hit_count), rng.choice([80.0, 90.0, 95.0, 100.0], hit_count))
+    assert_same_update(df, blast_hits([(row, f"ARO:30000{number}", f"reference_{name}", pident) for row, number, name, pident in hits]))